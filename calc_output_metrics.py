@@ -15,6 +15,14 @@ import numpy as np
 import pandas as pd
 import datetime
 
+# pmax contract cost (€/year per threshold of max. power, kW)
+CONTRACTED_P_TARIFFS = {6: 123.6, 9: 151.32, 12: 177.24, 15: 201.36,
+                        18: 223.68, 24: 274.68, 30: 299.52, 36: 337.56}
+# weights for the different collective microgrid metrics
+# N.B. pour l'instant "mg_transfo_aging" et "n_disj" pas utilisés
+COLL_METRICS_WEIGHTS = {"pmax_cost": 1/365, "autonomy_score": 1,
+                        "mg_transfo_aging": 0, "n_disj": 0}
+
 # Q2OJ : quid si plantage dans le run d'une equipe -> sortie ?
 # Qui verifie que les formats des profils de charge sont bons? (taille/type)
 # ATTENTION Puissance dans "load" ?
@@ -158,6 +166,25 @@ def calculate_bill(load_profile: np.ndarray, purchase_price: np.ndarray,
     
     return delta_t_s/3600 * sum(np.maximum(load_profile, 0) * purchase_price \
                                     + np.minimum(load_profile, 0) * sale_price)
+
+def calculate_bills(load_profiles: np.ndarray, purchase_price: np.ndarray,
+                    sale_price: np.ndarray, delta_t_s: int) -> np.ndarray:
+    """
+    Calculate bills of a batch of load profiles at once (vectorized calculate_bill)
+    
+    :param load_profiles: array of load profiles (kW) with time-slots on the last
+    axis, e.g. (actors x time-slots) or (iterations x scenarios x actors x time-slots)
+    :param purchase_price: elec. purchase price in €/kWh, applied to positive
+    flows; must broadcast against load_profiles
+    :param sale_price: elec. sale price in €/kWh, applied to negative flows
+    :param delta_t_s: time-slot duration of the considered discrete time model
+    :return: returns an array with the shape of load_profiles without its last
+    axis and values the associated bills
+    """
+    
+    load_profiles = np.asarray(load_profiles, dtype=float)
+    return delta_t_s/3600 * np.sum(np.maximum(load_profiles, 0) * purchase_price \
+                                       + np.minimum(load_profiles, 0) * sale_price, axis=-1)
         
 def calculate_microgrid_profile(per_actor_load_prof: dict) -> np.ndarray:
     """
@@ -290,8 +317,21 @@ def get_best_team_per_region(per_actor_bills: dict, collective_metrics: dict,
                                      coll_metrics_weights, iter_choice_rule)
     
     # get best team per region
+    best_teams_per_region = get_best_teams(team_scores)
+        
+    return team_scores, best_teams_per_region, coll_metrics_names
+
+def get_best_teams(team_scores: dict) -> dict:
+    """
+    Get best microgrid teams per region from their scores
+    
+    :param team_scores: dict. 1. team names ; 2. region names and values the scores
+    :return: returns the best team(s) (names) in each of the regions
+    """
+    
+    regions = list(team_scores[list(team_scores)[0]]) if team_scores else []
     best_teams_per_region = {}
-    for region in regions_simu:
+    for region in regions:
         current_scores = [team_scores[team][region] for team in team_scores]
         current_best = min(current_scores)
         
@@ -299,7 +339,7 @@ def get_best_team_per_region(per_actor_bills: dict, collective_metrics: dict,
         best_teams_per_region[region] = [team for team in team_scores \
                                          if team_scores[team][region] == current_best]
         
-    return team_scores, best_teams_per_region, coll_metrics_names
+    return best_teams_per_region
 
 def get_france_team_classif(team_scores: dict) -> dict:
     """
@@ -454,7 +494,7 @@ def calculate_team_score(team_name: str, region: str, per_actor_bills: dict,
                     last_iter = list(per_actor_bills[ic_scen][dc_scen] \
                                                      [region][ev_scen][team_name])[-1]
                     
-                    score = \
+                    score += \
                       calc_total_bill_and_score_fixed_iter(per_actor_bills[ic_scen] \
                                [dc_scen][region][ev_scen][team_name][last_iter],
                              collective_metrics[ic_scen][dc_scen][region] \
@@ -509,6 +549,52 @@ def calc_total_bill_and_score_fixed_iter(per_actor_bills_fixed_scen_and_iter: di
                                                        in coll_metrics_names])
     return total_bill, score_of_iter
 
+def calc_game_metrics(per_actor_load_prof: dict, purchase_price: np.ndarray,
+                      sale_price: np.ndarray, delta_t_s: int,
+                      contracted_p_tariffs: dict=CONTRACTED_P_TARIFFS,
+                      coll_metrics_weights: dict=COLL_METRICS_WEIGHTS) -> dict:
+    """
+    Calculate per-actor bills, collective metrics and score of a single game,
+    i.e. for a fixed (IC,DC,PV,EV) scenario and a fixed iteration of the
+    price-coordination method
+    
+    :param per_actor_load_prof: dict. with keys the actor names and values 
+    their load profile (kW)
+    :param purchase_price: elec. purchase price in €/kWh (>= 0)
+    :param sale_price: elec. sale price in €/kWh (>= 0)
+    :param delta_t_s: time-slot duration of the considered discrete time model
+    :param contracted_p_tariffs: tariff of contracted power, see
+    calc_microgrid_collective_metrics
+    :param coll_metrics_weights: dict. with keys the names of the different
+    collective metrics and values the associated weights
+    :return: returns a dict. with keys "total_bill", "score", the collective
+    metrics names and "bill_<actor name>", and values the associated floats
+    """
+    
+    actors = list(per_actor_load_prof)
+    bills = calculate_bills([per_actor_load_prof[actor] for actor in actors],
+                            purchase_price, sale_price, delta_t_s)
+    per_actor_bills = dict(zip(actors, bills))
+    
+    microgrid_prof = calculate_microgrid_profile(per_actor_load_prof)
+    collective_metrics = {"pmax_cost": calculate_pmax_cost(microgrid_prof,
+                                                           contracted_p_tariffs)[1],
+                          "autonomy_score": calculate_autonomy_score(microgrid_prof,
+                                                                     delta_t_s),
+                          "mg_transfo_aging": calculate_transfo_aging(microgrid_prof,
+                                                                      delta_t_s),
+                          "n_disj": calculate_number_of_disj(microgrid_prof, delta_t_s)}
+    total_bill, score = calc_total_bill_and_score_fixed_iter(per_actor_bills,
+                                                             collective_metrics,
+                                                             list(collective_metrics),
+                                                             coll_metrics_weights)
+    
+    game_metrics = {"total_bill": float(total_bill), "score": float(score)}
+    game_metrics.update({name: float(value) for name, value in collective_metrics.items()})
+    game_metrics.update({"bill_%s" % actor: float(per_actor_bills[actor]) for actor in actors})
+    
+    return game_metrics
+
 def calc_cost_autonomy_tradeoff_last_iter(per_actor_bills: dict, 
                                           collective_metrics: dict) -> dict:
 
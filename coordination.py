@@ -0,0 +1,261 @@
+# python 3
+#
+# convergence monitoring, price updates and warm-start of the price-coordination loop of the manager
+
+import os
+import json
+import time
+import numpy as np
+
+
+class StoppingCriteria:
+    """stopping criteria of the price-coordination loop
+
+    the loop has converged once every enabled tolerance holds:
+    - price_tol: max. absolute change of the purchase and sale prices (€/kWh)
+    - residual_tol: load imbalance, i.e. std. of the microgrid load over the day (kW)
+    - bill_tol: relative change of the microgrid bill between two iterations
+    and it is stopped anyway after max_time seconds of wall time in a game.
+    A criterion set to None is not checked (all None: the loop runs every iteration)
+    """
+
+    def __init__(self, price_tol=None, residual_tol=None, bill_tol=None, max_time=None):
+        self.price_tol = price_tol
+        self.residual_tol = residual_tol
+        self.bill_tol = bill_tol
+        self.max_time = max_time
+        self.start()
+
+    def settings(self):
+        """parameters of the criteria (see result_cache)"""
+        return {'price_tol': self.price_tol, 'residual_tol': self.residual_tol,
+                'bill_tol': self.bill_tol, 'max_time': self.max_time}
+
+    def start(self):
+        """called at the beginning of each game"""
+        self.start_time = time.perf_counter()
+        self.last_bill = None
+
+    def check(self, prices, new_prices, microgrid_load, microgrid_bill):
+        """return (reason to stop or None, residuals of the iteration)"""
+        price_change = max(np.max(np.abs(new_prices[name] - prices[name])) for name in ('purchase', 'sale'))
+        load_residual = np.std(microgrid_load)
+        if self.last_bill is None:
+            bill_change = np.inf
+        else:
+            bill_change = abs(microgrid_bill - self.last_bill) / max(abs(self.last_bill), 1e-12)
+        self.last_bill = microgrid_bill
+        elapsed = time.perf_counter() - self.start_time
+
+        residuals = {
+            'price_change': float(price_change),
+            'load_residual': float(load_residual),
+            'bill_change': float(bill_change),
+            'time': elapsed,
+        }
+
+        tolerances = [(self.price_tol, price_change), (self.residual_tol, load_residual),
+                      (self.bill_tol, bill_change)]
+        enabled = [(tol, value) for tol, value in tolerances if tol is not None]
+        if enabled and all(value <= tol for tol, value in enabled):
+            return 'converged', residuals
+        if self.max_time is not None and elapsed >= self.max_time:
+            return 'time', residuals
+        return None, residuals
+
+
+class PriceUpdate:
+    """price update of the coordination loop, from the microgrid load of the last iteration
+
+    subclasses implement update() on one price vector; purchase and sale prices
+    are updated independently, with their own state. With separate=True the
+    purchase prices follow the imports of the microgrid (positive load) and
+    the sale prices its exports (negative load), otherwise both follow the
+    whole microgrid load
+    """
+
+    def __init__(self, step=1e-3, separate=False):
+        self.step = step
+        self.separate = separate
+        self.reset()
+
+    def reset(self):
+        """called at the beginning of each game"""
+        self.state = {'purchase': {}, 'sale': {}}
+
+    def settings(self):
+        """class and parameters of the price update (see result_cache)"""
+        settings = {name: value for name, value in vars(self).items() if name != 'state'}
+        settings['class'] = type(self).__name__
+        return settings
+
+    def gradient(self, name, microgrid_load):
+        if not self.separate:
+            flow = microgrid_load
+        elif name == 'purchase':
+            flow = np.maximum(microgrid_load, 0)
+        else:
+            flow = np.minimum(microgrid_load, 0)
+        return flow - np.mean(flow)
+
+    def next_prices(self, iteration, prices, microgrid_load):
+        return {name: self.update(self.state[name], iteration, np.asarray(prices[name], dtype=float),
+                                  self.gradient(name, microgrid_load))
+                for name in ('purchase', 'sale')}
+
+    def update(self, state, iteration, price, grad):
+        raise NotImplementedError
+
+
+class GradientStep(PriceUpdate):
+    """fixed-decay gradient step: p + step * decay**iteration * grad"""
+
+    def __init__(self, step=1e-3, decay=0.99, separate=False):
+        self.decay = decay
+        super().__init__(step, separate)
+
+    def update(self, state, iteration, price, grad):
+        return price + self.step * self.decay**iteration * grad
+
+
+class HeavyBall(PriceUpdate):
+    """gradient step with heavy-ball momentum: p + step * grad + beta * (p - p_prev)"""
+
+    def __init__(self, step=1e-3, beta=0.5, separate=False):
+        self.beta = beta
+        super().__init__(step, separate)
+
+    def update(self, state, iteration, price, grad):
+        new_price = price + self.step * grad
+        if 'price' in state:
+            new_price += self.beta * (price - state['price'])
+        state['price'] = price
+        return new_price
+
+
+class Nesterov(PriceUpdate):
+    """Nesterov accelerated gradient: the prices sent to the players are the look-ahead point"""
+
+    def __init__(self, step=1e-3, beta=0.5, separate=False):
+        self.beta = beta
+        super().__init__(step, separate)
+
+    def update(self, state, iteration, price, grad):
+        x = price + self.step * grad
+        x_prev = state.get('x', price)
+        state['x'] = x
+        return x + self.beta * (x - x_prev)
+
+
+class BarzilaiBorwein(PriceUpdate):
+    """gradient step whose length is adapted with the Barzilai-Borwein rule |s.s / s.y|"""
+
+    def __init__(self, step=1e-3, min_step=1e-6, max_step=1e-1, separate=False):
+        self.min_step = min_step
+        self.max_step = max_step
+        super().__init__(step, separate)
+
+    def update(self, state, iteration, price, grad):
+        step = state.get('step', self.step)
+        if 'price' in state:
+            s = price - state['price']
+            y = grad - state['grad']
+            sy = abs(np.dot(s, y))
+            if sy > 1e-12:
+                step = float(np.clip(np.dot(s, s) / sy, self.min_step, self.max_step))
+        state.update(price=price, grad=grad, step=step)
+        return price + step * grad
+
+
+class Anderson(PriceUpdate):
+    """Anderson acceleration of the fixed point p = G(p) = p + step * grad(p)
+
+    the next prices mix the last `memory` values of G with the coefficients
+    that best cancel the residuals G(p) - p in the least-squares sense
+    """
+
+    def __init__(self, step=1e-3, memory=3, regularization=1e-10, separate=False):
+        self.memory = memory
+        self.regularization = regularization
+        super().__init__(step, separate)
+
+    def update(self, state, iteration, price, grad):
+        g = price + self.step * grad
+        f = g - price
+        history = state.setdefault('history', [])
+        history.append((g, f))
+        del history[:-(self.memory + 1)]
+        if len(history) == 1:
+            return g
+        dg = np.array([history[i + 1][0] - history[i][0] for i in range(len(history) - 1)]).T
+        df = np.array([history[i + 1][1] - history[i][1] for i in range(len(history) - 1)]).T
+        gram = df.T @ df + self.regularization * np.eye(df.shape[1])
+        gamma = np.linalg.solve(gram, df.T @ f)
+        return g - dg @ gamma
+
+
+# price updates selectable from run.py
+PRICE_UPDATES = {
+    'gradient': GradientStep,
+    'heavy_ball': HeavyBall,
+    'nesterov': Nesterov,
+    'bb': BarzilaiBorwein,
+    'anderson': Anderson,
+}
+
+
+class PriceCache:
+    """converged prices of the games already played, used to warm-start the next ones
+
+    a game is identified by the team, its non-PV scenarios (IC, DC, EV), its PV
+    region and day. A new game starts from the prices of the same game if it was
+    already played, else from those of the game of the same team and non-PV
+    scenarios whose PV profile is the closest (typically a neighbouring region).
+    The cache is persisted as json in path, when given
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.games = {}
+        self.hits = {'exact': 0, 'similar': 0, 'miss': 0}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.games = json.load(f)
+
+    @staticmethod
+    def key(team, others, region, pv_day):
+        return json.dumps([team, [int(i) for i in others], region, int(pv_day)])
+
+    def lookup(self, team, others, region, pv_day, pv_profile):
+        """prices to start the game with, or None"""
+        game = self.games.get(self.key(team, others, region, pv_day))
+        if game is not None:
+            self.hits['exact'] += 1
+        else:
+            others = [int(i) for i in others]
+            candidates = [g for g in self.games.values()
+                          if g['team'] == team and g['others'] == others and len(g['pv_profile']) == len(pv_profile)]
+            if not candidates:
+                self.hits['miss'] += 1
+                return None
+            distances = [np.linalg.norm(np.asarray(g['pv_profile']) - pv_profile) for g in candidates]
+            game = candidates[int(np.argmin(distances))]
+            self.hits['similar'] += 1
+        return {name: np.array(game[name]) for name in ('purchase', 'sale')}
+
+    def add(self, team, others, region, pv_day, pv_profile, prices):
+        self.games[self.key(team, others, region, pv_day)] = {
+            'team': team,
+            'others': [int(i) for i in others],
+            'pv_profile': [float(x) for x in pv_profile],
+            'purchase': [float(x) for x in prices['purchase']],
+            'sale': [float(x) for x in prices['sale']],
+        }
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.games, f)
+        os.replace(tmp_path, self.path)
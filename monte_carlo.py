@@ -0,0 +1,133 @@
+# python 3
+#
+# incremental statistics of the Monte-Carlo runs of the manager
+
+from collections import defaultdict
+import numpy as np
+import pandas
+
+
+class RunningStats:
+    """
+    running weighted mean and variance (West's weighted Welford) of scalars
+    or arrays, in constant memory; all the weights are 1 for plain Monte-Carlo
+    draws, see scenario_plan.ScenarioPlan for weighted designs
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.weight_sum = 0.
+        self.weight_sq_sum = 0.
+        self.mean = 0.
+        self._m2 = 0.
+
+    def update(self, value, weight=1.):
+        value = np.asarray(value, dtype=float)
+        self.count += 1
+        self.weight_sum += weight
+        self.weight_sq_sum += weight**2
+        delta = value - self.mean
+        self.mean = self.mean + delta * weight / self.weight_sum
+        self._m2 = self._m2 + weight * delta * (value - self.mean)
+
+    @property
+    def effective_count(self):
+        """Kish effective sample size, the number of samples with unit weights"""
+        if self.count == 0:
+            return 0.
+        return self.weight_sum**2 / self.weight_sq_sum
+
+    @property
+    def variance(self):
+        """unbiased sample variance (nan with less than two samples)"""
+        if self.count < 2:
+            return np.full(np.shape(self.mean), np.nan)[()]
+        return self._m2 / (self.weight_sum - self.weight_sq_sum / self.weight_sum)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def sem(self):
+        """standard error of the mean"""
+        return self.std / np.sqrt(max(self.effective_count, 1))
+
+    def confidence_interval(self, z=1.96):
+        """normal approximation of the confidence interval of the mean (95% by default)"""
+        half_width = z * self.sem
+        return self.mean - half_width, self.mean + half_width
+
+
+def record_metrics(region_statistics, metrics: dict, weight=1.):
+    """add the metrics of one game, with its weight, to {metric: RunningStats}"""
+    for name, value in metrics.items():
+        region_statistics[name].update(value, weight)
+
+
+def new_region_statistics():
+    return defaultdict(RunningStats)
+
+
+def statistics_to_dataframe(team_statistics: dict, z=1.96):
+    """
+    flatten {team: {region: {metric: RunningStats}}} into a dataframe with one row
+    per (team, region, metric) for the scalar metrics
+    """
+    rows = []
+    for team, regions in team_statistics.items():
+        for region, metrics in regions.items():
+            for metric, stats in metrics.items():
+                if np.ndim(stats.mean) != 0:
+                    continue
+                low, high = stats.confidence_interval(z)
+                rows.append({'team': team, 'region': region, 'metric': metric, 'n': stats.count,
+                             'mean': float(stats.mean), 'std': float(stats.std),
+                             'ci_low': float(low), 'ci_high': float(high)})
+    return pandas.DataFrame(rows, columns=['team', 'region', 'metric', 'n', 'mean', 'std', 'ci_low', 'ci_high'])
+
+
+def overlapping_teams(team_statistics: dict, metric='score', z=1.96):
+    """teams whose confidence interval on metric overlaps another team's in at least one region"""
+    overlapping = set()
+    teams = list(team_statistics)
+    for i, team in enumerate(teams):
+        for other in teams[i+1:]:
+            for region, metrics in team_statistics[team].items():
+                if region not in team_statistics[other]:
+                    continue
+                low, high = metrics[metric].confidence_interval(z)
+                other_low, other_high = team_statistics[other][region][metric].confidence_interval(z)
+                # nan bounds (less than two samples) are never settled
+                if not (high < other_low or other_high < low):
+                    overlapping.update((team, other))
+    return overlapping
+
+
+def adaptive_sampling(team_statistics: dict, play, max_samples: int, batch=1, metric='score', z=1.96):
+    """
+    keep playing scenario draws for the teams whose per-region score is not settled yet
+
+    :param team_statistics: dict. with keys the team names and values their
+    statistics {region: {metric: RunningStats}}, with a few draws already played
+    :param play: function playing more draws, called with a dict. with keys the
+    team names and values the number of draws to add to their statistics
+    :param max_samples: budget of draws per team
+    :param batch: number of draws played per team between two checks
+    :param metric: metric of the statistics that ranks the teams (per game
+    score, as in calc_output_metrics.calculate_team_score)
+    :param z: quantile of the confidence intervals (1.96 -> 95%)
+    :return: returns a dict. with keys the team names and values the number of
+    draws played for them
+    """
+    def samples(team):
+        return min(stats[metric].count for stats in team_statistics[team].values())
+
+    while True:
+        active = sorted(team for team in overlapping_teams(team_statistics, metric, z)
+                        if samples(team) < max_samples)
+        if not active:
+            break
+        play({team: min(batch, max_samples - samples(team)) for team in active})
+
+    return {team: samples(team) for team in team_statistics}
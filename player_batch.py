@@ -0,0 +1,41 @@
+# python 3
+#
+# batched player protocol: evaluate many (price vector, scenario) pairs in one call
+#
+# a player may implement
+#     compute_all_load_batch(prices, scenarios) -> array (k x time-slots)
+# with prices a dict. {"purchase": (k x time-slots), "sale": (k x time-slots)}
+# and scenarios a list of k scenario data (as given to set_scenario). Each of
+# the k evaluations is independent, i.e. starts from the reset player
+
+import numpy as np
+
+
+class ScalarPlayerAdapter:
+    """batched protocol on top of the scalar API of a player (reset, set_scenario, set_prices, compute_all_load)"""
+
+    def __init__(self, player):
+        self.player = player
+
+    def compute_all_load_batch(self, prices, scenarios):
+        loads = []
+        for k, scenario in enumerate(scenarios):
+            self.player.reset()
+            if scenario is not None:
+                self.player.set_scenario(scenario)
+            self.player.set_prices({name: prices[name][k] for name in ('purchase', 'sale')})
+            loads.append(self.player.compute_all_load())
+        return np.array(loads, dtype=float)
+
+
+def batch_player(player):
+    """the player itself if it implements the batched protocol, else its scalar adapter"""
+    if hasattr(player, 'compute_all_load_batch'):
+        return player
+    return ScalarPlayerAdapter(player)
+
+
+def broadcast_prices(prices, k, nb_pdt):
+    """prices (time-slots) or (k x time-slots) as a dict. of (k x time-slots) arrays"""
+    return {name: np.broadcast_to(np.asarray(prices[name], dtype=float), (k, nb_pdt))
+            for name in ('purchase', 'sale')}
@@ -0,0 +1,133 @@
+# python 3
+#
+# memoization of the responses of pure players: a player declaring pure = True
+# returns the same load for the same scenario and prices, so repeated
+# evaluations (all-zero prices of the first iteration, non-PV players seeing the
+# same scenario in every region...) are served from an LRU cache
+
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def digest(*arrays):
+    """hash of the content of arrays (scenario data, price vectors)"""
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(str((array.shape, array.dtype.str)).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def is_pure(player):
+    return bool(getattr(player, 'pure', False))
+
+
+def player_identity(player):
+    """what distinguishes the players in the cache: their code (and team, through the module)"""
+    module_name = getattr(player, 'module_name', None)
+    if module_name is None:
+        module_name = f'{type(player).__module__}.{type(player).__qualname__}'
+    return module_name
+
+
+class ResponseCache:
+    """LRU cache of player loads, with at most max_size entries, shared by the players of a process"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            load = self.entries.get(key)
+            if load is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return load.copy()
+
+    def put(self, key, load):
+        with self._lock:
+            self.entries[key] = np.array(load, dtype=float)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                'hit_rate': self.hits / calls if calls else 0.}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class MemoizedPlayer:
+    """
+    a pure player whose compute_all_load is looked up in a ResponseCache, keyed
+    by the player identity and the digests of its scenario and prices
+
+    set_scenario, set_prices and reset are still forwarded to the player, so
+    that it is up to date when a response is not in the cache
+    """
+
+    def __init__(self, player, cache):
+        self.player = player
+        self.cache = cache
+        self.identity = player_identity(player)
+        self.scenario_digest = None
+        self.prices_digest = None
+
+    def __getattr__(self, name):
+        # the rest of the player API (and the attributes set by the manager)
+        if name == 'player':
+            raise AttributeError(name)
+        return getattr(self.player, name)
+
+    def reset(self):
+        self.scenario_digest = None
+        self.prices_digest = None
+        self.player.reset()
+
+    def set_scenario(self, scenario_data):
+        self.scenario_digest = digest(scenario_data)
+        self.player.set_scenario(scenario_data)
+
+    def set_prices(self, prices):
+        self.prices_digest = digest(prices['purchase'], prices['sale'])
+        self.player.set_prices(prices)
+
+    def key(self):
+        return self.identity, self.scenario_digest, self.prices_digest
+
+    def cached_load(self):
+        """load of the current scenario and prices in the cache, or None"""
+        return self.cache.get(self.key())
+
+    def remember(self, load):
+        self.cache.put(self.key(), load)
+
+    def compute_all_load(self):
+        load = self.cached_load()
+        if load is None:
+            load = self.player.compute_all_load()
+            self.remember(load)
+        return load
+
+
+def unwrap(player):
+    """the player behind a MemoizedPlayer"""
+    return player.player if isinstance(player, MemoizedPlayer) else player
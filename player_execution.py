@@ -0,0 +1,97 @@
+# python 3
+#
+# execution backends of the players of a coordination iteration: their
+# compute_all_load calls are independent given the prices, so they can run
+# concurrently, the microgrid load being gathered once all of them are done
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from player_cache import MemoizedPlayer, unwrap
+
+
+def compute_load(player):
+    return player.compute_all_load()
+
+
+def compute_load_remote(player):
+    """compute_all_load in a worker process, returning the updated player with its load"""
+    return player.compute_all_load(), player
+
+
+class SerialBackend:
+    """players evaluated one after another, in the manager process"""
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._executor = None
+
+    def compute_loads(self, players):
+        return [compute_load(player) for player in players]
+
+    def close(self):
+        pass
+
+
+class ThreadBackend(SerialBackend):
+    """
+    players evaluated by a thread pool: for players whose work releases the GIL
+    (LP/MILP solvers such as pulp or gurobipy, numpy)
+
+    the players drawing from the global random generators are not reproducible
+    with concurrent backends
+    """
+
+    def executor(self):
+        # created on first use, so that an unused backend can be copied and pickled
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    def compute_loads(self, players):
+        return list(self.executor().map(compute_load, players))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+
+class ProcessBackend(ThreadBackend):
+    """
+    players evaluated by a process pool, for pure python players holding the GIL
+
+    each call sends the (pickled) player to a worker and copies its state back
+    in the player of the manager, so the players must be picklable. The
+    response cache of memoized players is looked up in the manager process,
+    only the players missing from it are sent
+    """
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def compute_loads(self, players):
+        loads = [player.cached_load() if isinstance(player, MemoizedPlayer) else None for player in players]
+        missing = [i for i, load in enumerate(loads) if load is None]
+        remote = self.executor().map(compute_load_remote, [unwrap(players[i]) for i in missing])
+        for i, (load, remote_player) in zip(missing, remote):
+            unwrap(players[i]).__dict__.update(remote_player.__dict__)
+            if isinstance(players[i], MemoizedPlayer):
+                players[i].remember(load)
+            loads[i] = load
+        return loads
+
+
+# player backends selectable from run.py
+PLAYER_BACKENDS = {
+    'serial': SerialBackend,
+    'thread': ThreadBackend,
+    'process': ProcessBackend,
+}
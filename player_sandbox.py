@@ -0,0 +1,360 @@
+# python 3
+#
+# players hosted in long-lived worker processes, with per-call cpu time, wall
+# time and memory budgets: a slow, crashing or runaway player only fails its
+# own calls (penalised in the score by the manager) instead of the whole run
+
+import time
+import math
+import random
+import signal
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory, util
+from collections import namedtuple
+import numpy as np
+
+from scenario_store import attach_shared_memory
+
+try:
+    import resource
+except ImportError:
+    # not available on windows: only the wall time budget is enforced
+    resource = None
+
+
+# budgets of a player call: cpu and wall time in seconds, memory (address space) in MB; None for no limit
+SandboxLimits = namedtuple('SandboxLimits', ['cpu_time', 'wall_time', 'memory_mb'], defaults=[None, None, None])
+
+# optional methods of the player API, forwarded when the hosted player implements them
+OPTIONAL_METHODS = ['get_state', 'set_state', 'compute_all_load_batch']
+
+
+def set_time_step(player, dt):
+    """same rule as Manager.set_player_time_step, applied in the worker"""
+    if hasattr(player, 'set_time_step'):
+        player.set_time_step(dt)
+    elif hasattr(player, 'dt'):
+        player.dt = dt
+
+
+def seed_generators(np_seed, py_seed):
+    """same seeding of the global generators as Manager.prepare_game, applied in the worker"""
+    random.seed(py_seed)
+    np.random.seed(np_seed)
+
+
+class SharedSlots:
+    """
+    ring of pre-allocated shared memory slots for the price vectors sent to a
+    player and the load vectors it returns: only the slot index goes through
+    the pipe of the worker. The creating process owns (and unlinks) the block
+    """
+
+    def __init__(self, nb_pdt, nb_slots=2, name=None):
+        self.nb_pdt = nb_pdt
+        self.nb_slots = nb_slots
+        size = nb_slots * 3 * nb_pdt * 8
+        if name is None:
+            self.block = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.block = attach_shared_memory(name)
+            self.owner = False
+        # (slot x purchase/sale/load x time-slot)
+        self.array = np.ndarray((nb_slots, 3, nb_pdt), dtype=np.float64, buffer=self.block.buf)
+        self.next_slot = 0
+        # also released when a (pool worker) process exits without closing its players
+        self._finalizer = util.Finalize(self, SharedSlots.release, args=(self.block, self.owner), exitpriority=10)
+
+    @property
+    def spec(self):
+        """what the worker needs to attach to the slots"""
+        return self.block.name, self.nb_pdt, self.nb_slots
+
+    def write_prices(self, prices):
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.nb_slots
+        self.array[slot, 0] = prices['purchase']
+        self.array[slot, 1] = prices['sale']
+        return slot
+
+    def read_prices(self, slot):
+        # copied: the player may keep them while the slot is reused
+        return {'purchase': self.array[slot, 0].copy(), 'sale': self.array[slot, 1].copy()}
+
+    def close(self):
+        self.array = None
+        self._finalizer()
+
+    @staticmethod
+    def release(block, owner):
+        block.close()
+        if owner:
+            block.unlink()
+
+
+def serve_player(conn, module_name, memory_mb):
+    """loop of the worker process: import the player once, then run the calls received on conn"""
+    if resource is not None and memory_mb is not None:
+        limit = int(memory_mb * 2**20)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    try:
+        player = __import__(module_name, fromlist=["Player"]).Player()
+    except BaseException:
+        conn.send(('error', traceback.format_exc(), 0., 0.))
+        return
+    conn.send(('ok', {'methods': [name for name in OPTIONAL_METHODS if hasattr(player, name)],
+                      'pure': bool(getattr(player, 'pure', False))}, 0., 0.))
+
+    slots = None
+    # error of a call without reply (set_prices_slot), reported on the next call
+    pending_error = None
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        method, args, cpu_time = request
+        if method == 'attach':
+            if slots is not None:
+                slots.close()
+            slots = SharedSlots(*args[1:], name=args[0])
+            conn.send(('ok', None, 0., 0.))
+            continue
+        if pending_error is not None:
+            conn.send(('error', pending_error, 0., 0.))
+            pending_error = None
+            continue
+        start = time.process_time()
+        if resource is not None and cpu_time is not None:
+            soft = math.ceil(start + cpu_time)
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        try:
+            if method == 'set_time_step':
+                result = set_time_step(player, *args)
+            elif method == 'seed':
+                result = seed_generators(*args)
+            elif method == 'set_prices_slot':
+                result = player.set_prices(slots.read_prices(*args))
+            elif method == 'compute_all_load_slot':
+                slot, = args
+                slots.array[slot, 2] = player.compute_all_load()
+                result = slot
+            else:
+                result = getattr(player, method)(*args)
+            status = 'ok'
+        except BaseException:
+            status, result = 'error', traceback.format_exc()
+        if method == 'set_prices_slot':
+            # one-way call: the prices are followed by compute_all_load_slot
+            if status != 'ok':
+                pending_error = result
+            continue
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource is not None else 0.
+        conn.send((status, result, time.process_time() - start, max_rss))
+
+
+class PlayerProxy:
+    """
+    a player of module_name hosted in its own worker process, with the player API
+
+    the player is imported once and reused for every game. A call exceeding
+    the budgets of limits, raising or crashing the worker is a failed call:
+    the worker is restarted (with the last scenario and prices sent to it),
+    compute_all_load returns a zero load and failed_calls is incremented, for
+    the manager to penalise the game. A player whose import (or constructor)
+    raises or exceeds the wall time budget is broken: all its calls fail.
+    usage reports the calls, failures and resources of the player.
+
+    With shared_slots, prices and loads go through SharedSlots and the pipe
+    only carries the method names and slot indices; otherwise they are pickled
+    """
+
+    def __init__(self, module_name, limits=SandboxLimits(), shared_slots=True):
+        self.module_name = module_name
+        self.limits = limits
+        self.shared_slots = shared_slots
+        self._slots = None
+        self.failed_calls = 0
+        self.usage = {'calls': 0, 'failures': 0, 'timeouts': 0, 'restarts': 0,
+                      'cpu_time': 0., 'wall_time': 0., 'max_rss_mb': 0.}
+        self.errors = []
+        self._process = None
+        self._conn = None
+        self._replay = {}
+        self._nb_pdt = 48
+        # reason why the player cannot be started, if any
+        self.broken = None
+        description = self._start()
+        if description is None:
+            description = {'methods': [], 'pure': False}
+        # see player_cache, for the players declaring themselves pure
+        self.pure = description['pure']
+        for name in description['methods']:
+            setattr(self, name, self._forward(name))
+
+    def _forward(self, name):
+        def call(*args):
+            return self._call(name, *args)
+        return call
+
+    def _start(self):
+        """start the worker, return the description of the player, or None (and the proxy is broken)"""
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=serve_player,
+                                        args=(child_conn, self.module_name, self.limits.memory_mb), daemon=True)
+        self._process.start()
+        child_conn.close()
+        try:
+            if not self._conn.poll(self.limits.wall_time):
+                self.usage['timeouts'] += 1
+                status, result = 'error', f'import of the player exceeded {self.limits.wall_time} s'
+            else:
+                status, result, _, _ = self._conn.recv()
+        except (EOFError, OSError):
+            self._process.join(1)
+            status, result = 'error', f'import of the player crashed (exit code {self._process.exitcode})'
+        if status != 'ok':
+            self._stop()
+            self.broken = f'player {self.module_name} could not be started:\n{result}'
+            self.failed_calls += 1
+            self.usage['failures'] += 1
+            self.errors = (self.errors + [self.broken])[-10:]
+            return None
+        if self._slots is not None:
+            self._send('attach', self._slots.spec)
+        return result
+
+    def _stop(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def _restart(self):
+        self._stop()
+        self.usage['restarts'] += 1
+        if self._start() is None:
+            return
+        # the new worker gets back the inputs of the current game
+        for method in ('set_time_step', 'seed', 'set_scenario', 'set_prices'):
+            if method in self._replay:
+                self._send(method, self._replay[method])
+
+    def _send(self, method, args):
+        """one call in the worker: (True, result) or (False, reason)"""
+        start = time.perf_counter()
+        try:
+            self._conn.send((method, args, self.limits.cpu_time))
+            if not self._conn.poll(self.limits.wall_time):
+                self.usage['timeouts'] += 1
+                return False, f'{method} exceeded {self.limits.wall_time} s'
+            status, result, cpu_time, max_rss = self._conn.recv()
+        except (EOFError, OSError):
+            self._process.join(1)
+            if self._process.exitcode == -getattr(signal, 'SIGXCPU', -1):
+                return False, f'{method} exceeded {self.limits.cpu_time} s of cpu time'
+            return False, f'{method} crashed the player (exit code {self._process.exitcode})'
+        finally:
+            self.usage['wall_time'] += time.perf_counter() - start
+        self.usage['cpu_time'] += cpu_time
+        self.usage['max_rss_mb'] = max(self.usage['max_rss_mb'], max_rss)
+        if status != 'ok':
+            return False, result
+        return True, result
+
+    def _call(self, method, *args):
+        if self.broken is None and (self._process is None or not self._process.is_alive()):
+            self._restart()
+        self.usage['calls'] += 1
+        if self.broken is not None:
+            ok, result = False, self.broken
+        else:
+            ok, result = self._send(method, args)
+        if ok:
+            return result
+        self.failed_calls += 1
+        self.usage['failures'] += 1
+        self.errors = (self.errors + [result])[-10:]
+        # the worker may be stuck or in an unknown state
+        self._stop()
+        return None
+
+    def set_time_step(self, dt):
+        self._nb_pdt = int(round(24 / dt))
+        self._replay['set_time_step'] = (dt,)
+        self._call('set_time_step', dt)
+
+    def seed(self, np_seed, py_seed):
+        """seed the global random generators of the worker for the next game"""
+        self._replay['seed'] = (np_seed, py_seed)
+        self._call('seed', np_seed, py_seed)
+
+    def reset(self):
+        self._replay.pop('set_scenario', None)
+        self._replay.pop('set_prices', None)
+        self._call('reset')
+
+    def set_scenario(self, scenario_data):
+        self._replay['set_scenario'] = (scenario_data,)
+        self._call('set_scenario', scenario_data)
+
+    def set_prices(self, prices):
+        self._nb_pdt = len(prices['purchase'])
+        self._replay['set_prices'] = (prices,)
+        if not self.shared_slots:
+            self._call('set_prices', prices)
+            return
+        if self._slots is None or self._slots.nb_pdt != self._nb_pdt:
+            self.attach_slots(self._nb_pdt)
+        self._post('set_prices_slot', self._slots.write_prices(prices))
+
+    def _post(self, method, *args):
+        """one-way call, its failure is reported by the next call"""
+        if self.broken is None and (self._process is None or not self._process.is_alive()):
+            self._restart()
+        self.usage['calls'] += 1
+        if self.broken is not None:
+            return
+        try:
+            self._conn.send((method, args, self.limits.cpu_time))
+        except OSError:
+            self._stop()
+
+    def attach_slots(self, nb_pdt):
+        """(re)allocate the shared slots for nb_pdt time-slots and attach the worker to them"""
+        if self._slots is not None:
+            self._slots.close()
+        self._slots = SharedSlots(nb_pdt)
+        if self._process is not None and self._process.is_alive():
+            ok, result = self._send('attach', self._slots.spec)
+            if not ok:
+                self._stop()
+
+    def compute_all_load(self):
+        if self._slots is None:
+            load = self._call('compute_all_load')
+        else:
+            slot = self._call('compute_all_load_slot', self._slots.next_slot)
+            load = None if slot is None else self._slots.array[slot, 2].copy()
+        if load is None:
+            return np.zeros(self._nb_pdt)
+        return load
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+        self._stop()
+        if self._slots is not None:
+            self._slots.close()
+            self._slots = None
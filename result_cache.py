@@ -0,0 +1,121 @@
+# python 3
+#
+# on-disk cache of the tournament results of each team, keyed by the git commit
+# of its code, the scenario plan, the scenarios and prices, and the settings of
+# the managers: a team whose code did not change since the last run is not
+# simulated again
+
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+from git import Repo, InvalidGitRepositoryError, NoSuchPathError
+
+
+def team_revision(team_name, team, players_dir):
+    """
+    git commit of the code of a team (one per player folder for the teams
+    given as a list, see checkout_code.py), or None if it cannot be trusted:
+    not a git repository, or uncommitted changes (byte-code of the imports aside)
+    """
+    if isinstance(team, dict):
+        code_paths = [os.path.join(players_dir, team_name)]
+    else:
+        code_paths = [os.path.join(players_dir, team_name, player['folder']) for player in team]
+    revisions = []
+    for code_path in code_paths:
+        try:
+            repo = Repo(code_path)
+            if repo.is_dirty() or any(not path.endswith('.pyc') for path in repo.untracked_files):
+                return None
+            revisions.append(repo.head.commit.hexsha)
+        except (InvalidGitRepositoryError, NoSuchPathError, ValueError):
+            return None
+    return '+'.join(revisions)
+
+
+def describe(value):
+    """json-friendly description of a setting of the managers"""
+    if hasattr(value, 'settings'):
+        return value.settings()
+    if hasattr(value, '_asdict'):
+        return value._asdict()
+    return value
+
+
+def store_digest(store):
+    """digest of the scenarios and prices of a store"""
+    h = hashlib.sha256()
+    for group in (store.arrays, store.prices):
+        for name in sorted(group):
+            array = np.ascontiguousarray(group[name])
+            h.update(f'{name}{array.shape}{array.dtype.str}'.encode())
+            h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def code_digest(code_dir):
+    """digest of the python sources of the manager in code_dir (scoring, coordination...)"""
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(code_dir)):
+        if name.endswith('.py'):
+            h.update(name.encode())
+            with open(os.path.join(code_dir, name), 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def context_digest(store_key, code_key, config, nb_draws):
+    """
+    digest of what the results of a team depend on, besides its code: the
+    scenarios and prices (store_key, see store_digest), the code of the
+    manager (code_key, see code_digest), the nb_draws first draws of the plan
+    and the settings of the tournament and of its managers
+    """
+    options = config['manager_options']
+    plan = options.get('plan')
+    # the player backends and response caches do not change the results (warm-started runs are not cached)
+    settings = {name: describe(value) for name, value in options.items()
+                if name not in ('plan', 'player_backend', 'response_cache', 'warm_start')}
+    context = {'store': store_key, 'code': code_key, 'regions': config['regions'], 'seed': config['seed'],
+               'slot_minutes': config['slot_minutes'], 'nb_draws': nb_draws, 'settings': settings,
+               'plan': None if plan is None else [plan.seed, plan.design, plan.draws[:nb_draws], plan.weights[:nb_draws]]}
+    return hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    """results of each (team, revision, context) as pickle files of directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = []
+        self.misses = []
+
+    def path(self, team_name, revision, context):
+        key = hashlib.sha256(f'{team_name}\n{revision}\n{context}'.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, f'{team_name}_{key}.pkl')
+
+    def load(self, team_name, revision, context):
+        """cached results of the team, or None"""
+        if revision is None:
+            self.misses.append(team_name)
+            return None
+        path = self.path(team_name, revision, context)
+        if not os.path.exists(path):
+            self.misses.append(team_name)
+            return None
+        with open(path, 'rb') as f:
+            results = pickle.load(f)
+        self.hits.append(team_name)
+        return results
+
+    def save(self, team_name, revision, context, results):
+        if revision is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(team_name, revision, context)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(results, f)
+        os.replace(tmp_path, path)
@@ -1,22 +1,17 @@
-import numpy as np
-from simulate import Manager
+from coordination import StoppingCriteria, PriceCache, PRICE_UPDATES
+from player_execution import PLAYER_BACKENDS
+from player_sandbox import SandboxLimits
+from player_cache import ResponseCache
+from result_cache import ResultCache
+from monte_carlo import statistics_to_dataframe, adaptive_sampling
+from tournament import Tournament
+from scenario_store import get_scenario_store
+from streaming import MetricsWriter
+from scenario_plan import ScenarioPlan, SAMPLING_DESIGNS, STRATA, REDUCED_SCENARIOS
 import time
 import os
 import argparse
 import json
-import tqdm
-
-
-def merge(a:dict, b:dict):
-	for k, v in b.items():
-		if k in a:
-			if isinstance(v, dict):
-				merge(a[k], v)
-			else:
-				a[k] = v
-		else:
-			a[k] = v
-
 
 
 if __name__ == '__main__':
@@ -24,10 +19,46 @@ if __name__ == '__main__':
 	parser.add_argument('-p', '--players', type=str, default='data/players.json', help='path to players.json file')
 	parser.add_argument('-c', '--prices', type=str, default='data/prices.csv', help='path to scenario file (prices.csv)')
 	parser.add_argument('-n', '--name', type=str, default='default', help='experiment name')
-	parser.add_argument('-s', '--scenarios', type=int, default=1, help='number of runs')
+	parser.add_argument('-s', '--scenarios', type=int, default=1, help='number of (IC, DC, EV) scenario draws played per team and region')
 	parser.add_argument('-r', '--regions', nargs='+', type=str, default=['all'], help='region names')
+	parser.add_argument('--slot-minutes', type=int, default=30, help='time-slot duration of the games (e.g. 60 for fast screening, 15 or 5 for fine runs)')
 	parser.add_argument('--seed', type=int, default=123, help='set random seed')
+	parser.add_argument('--plan', type=str, default=None, help='json scenario plan replayed for every team (created from --seed if missing)')
+	parser.add_argument('--sampling', type=str, default='random', choices=SAMPLING_DESIGNS, help='sampling design of the scenario draws (of a new --plan)')
+	parser.add_argument('--strata', nargs='+', type=str, default=['season', 'ic_site'], choices=list(STRATA), help='strata of --sampling stratified')
+	parser.add_argument('--reduce', nargs='+', type=str, default=[], metavar='TYPE=K', help='representative scenarios per player type of --sampling reduced, e.g. solar_farm=12 (default %s)' % REDUCED_SCENARIOS)
+	parser.add_argument('--stream', type=str, default=None, help='csv file of the per-game metrics, written chunk by chunk (a partial run is resumed)')
+	parser.add_argument('--chunk-size', type=int, default=30, help='scenario draws per chunk of --stream')
+	parser.add_argument('--rolling', action='store_true', help='play the draws as consecutive days, carrying player states and prices over (e.g. with --sampling full_year)')
+	parser.add_argument('--adaptive', action='store_true', help='after --scenarios draws, keep drawing for the teams whose score is not settled')
+	parser.add_argument('--max-scenarios', type=int, default=100, help='budget of draws per team of --adaptive')
+	parser.add_argument('--price-tol', type=float, default=None, help='stop a game when prices change by less than this (eur/kWh)')
+	parser.add_argument('--residual-tol', type=float, default=None, help='stop a game when the std. of the microgrid load is below this (kW)')
+	parser.add_argument('--bill-tol', type=float, default=None, help='stop a game when the microgrid bill changes by less than this (relative)')
+	parser.add_argument('--max-game-time', type=float, default=None, help='max. wall time of a game (s)')
+	parser.add_argument('--price-update', type=str, default='gradient', choices=list(PRICE_UPDATES), help='price update of the coordination loop')
+	parser.add_argument('--price-step', type=float, default=1e-3, help='(initial) step of the price update')
+	parser.add_argument('--separate-prices', action='store_true', help='update purchase prices from imports and sale prices from exports')
+	parser.add_argument('--warm-start', action='store_true', help='start each game from the prices of the closest game already played')
+	parser.add_argument('--price-cache', type=str, default=None, help='json file persisting the warm-start prices across runs')
+	parser.add_argument('--player-backend', type=str, default='serial', choices=list(PLAYER_BACKENDS), help='evaluation of the players of an iteration: serial, thread pool (GIL-releasing solvers) or process pool (a thread pool with --sandbox)')
+	parser.add_argument('--player-workers', type=int, default=None, help='threads/processes of --player-backend (default: executor default)')
+	parser.add_argument('--sandbox', action='store_true', help='host each player in its own worker process, with the budgets below per call')
+	parser.add_argument('--player-cpu-time', type=float, default=None, help='cpu time budget of a player call (s) of --sandbox')
+	parser.add_argument('--player-wall-time', type=float, default=None, help='wall time budget of a player call (s) of --sandbox')
+	parser.add_argument('--player-memory', type=float, default=None, help='memory budget of a player (MB) of --sandbox')
+	parser.add_argument('--failure-penalty', type=float, default=1000., help='score penalty (eur) of each failed player call of --sandbox')
+	parser.add_argument('--memoize', action='store_true', help='cache the loads of the players declaring pure = True, by scenario and prices')
+	parser.add_argument('--memoize-size', type=int, default=100000, help='max. number of loads kept by --memoize (per process)')
+	parser.add_argument('--result-cache', type=str, default=None, help='folder of the results of the teams by git commit: only the teams whose code changed are played again')
+	parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes')
 	args = parser.parse_args()
+	if args.warm_start and args.workers > 1:
+		parser.error('--warm-start chains the games of a run and needs --workers 1')
+	if args.adaptive and args.rolling:
+		parser.error('--rolling plays a fixed chain of days and cannot be combined with --adaptive')
+	if args.adaptive and args.sampling != 'random':
+		parser.error('the draws of --sampling %s are fixed, --adaptive needs --sampling random' % args.sampling)
 
 	name = args.name
 	this_dir = os.path.dirname(os.path.abspath(__file__))
@@ -47,19 +78,70 @@ if __name__ == '__main__':
 
 	with open(args.players, 'r') as file:
 		players = json.load(file)
-	full_data = {}
-	full_pv_profiles = {}
-	for team in tqdm.tqdm(players.keys()):
-		import random
-		random.seed(args.seed)
-		import numpy as np
-		np.random.seed(args.seed)
-		manager = Manager(team, args.players, args.prices, args.regions)
-		data, pv_profiles = manager.simulate(args.scenarios, name)
-		merge(full_data, data)
-		merge(full_pv_profiles, pv_profiles)
+	price_cache = PriceCache(args.price_cache) if args.warm_start else None
+	# every team plays the same scenario draws
+	sampling_options = {}
+	if args.sampling == 'stratified':
+		sampling_options['strata'] = args.strata
+	elif args.sampling == 'reduced':
+		sampling_options['nb_scenarios'] = {player_type: int(k) for player_type, k in (item.split('=') for item in args.reduce)}
+	store = get_scenario_store(args.prices, slot_minutes=args.slot_minutes)
+	plan = ScenarioPlan.load_or_create(args.plan, store, args.seed, args.scenarios, args.sampling, **sampling_options)
+	# sampling designs fix their own number of draws
+	nb_draws = args.scenarios if plan.design == 'random' else len(plan.draws)
+	manager_options = {
+		'plan': plan,
+		'stopping': StoppingCriteria(args.price_tol, args.residual_tol, args.bill_tol, args.max_game_time),
+		'price_update': PRICE_UPDATES[args.price_update](step=args.price_step, separate=args.separate_prices),
+		'warm_start': price_cache,
+		'player_backend': PLAYER_BACKENDS[args.player_backend](args.player_workers),
+		'sandbox': SandboxLimits(args.player_cpu_time, args.player_wall_time, args.player_memory) if args.sandbox else None,
+		'failure_penalty': args.failure_penalty,
+		'response_cache': ResponseCache(args.memoize_size) if args.memoize else None,
+	}
+	result_cache = ResultCache(args.result_cache) if args.result_cache is not None else None
+	# each (team, region, scenario) game is a task with its own seed: any number of workers gives the same results
+	with Tournament(args.players, players, args.prices, args.regions, manager_options,
+					seed=args.seed, workers=args.workers, slot_minutes=args.slot_minutes,
+					result_cache=result_cache, players_dir=os.path.join(this_dir, 'players')) as tournament:
+		if args.rolling:
+			tournament.roll(range(nb_draws), MetricsWriter(args.stream) if args.stream is not None else None)
+		elif args.stream is not None:
+			# e.g. --sampling full_year: the games are reduced and written chunk by chunk
+			tournament.stream(range(nb_draws), MetricsWriter(args.stream), args.chunk_size)
+		else:
+			tournament.play({team: nb_draws for team in players})
+		if args.adaptive:
+			samples_per_team = adaptive_sampling(tournament.statistics, tournament.play, args.max_scenarios)
+			print(f'scenario draws per team: {samples_per_team}')
+	saved_calls = tournament.saved_calls
+	full_data = tournament.data
+	full_pv_profiles = tournament.pv_profiles
+
+	print(f'coordination iterations saved by early stopping: {saved_calls}')
+	if result_cache is not None:
+		print(f'teams from the result cache: {result_cache.hits}, played: {[team for team in players if team not in result_cache.hits]}')
+	if args.memoize:
+		print(f'player response cache: {tournament.response_cache_stats}')
+	for team, usage in tournament.player_usage.items():
+		for player_type, player_usage in usage.items():
+			print(f'{team} {player_type}: {player_usage}')
+
+	# Monte-Carlo estimate of the scores, with 95% confidence intervals
+	mc_scores = statistics_to_dataframe(tournament.statistics)
+	mc_scores.to_csv(f'monte_carlo_{name}.csv', sep=';', decimal='.', index=False)
+	print(mc_scores[mc_scores['metric'] == 'score'].to_string(index=False))
+	if args.plan is not None:
+		# keep the draws added by --adaptive
+		plan.save(args.plan)
+	if price_cache is not None:
+		price_cache.save()
+		print(f'warm-start hits: {price_cache.hits}')
 
 	from visualize_v2 import generate_pptx
-	generate_pptx(full_data, full_pv_profiles)
+	# the scores of the summary are the (weighted) means over all the draws
+	mc_team_scores = {team: {region: statistics['score'].mean for region, statistics in team_statistics.items()}
+					  for team, team_statistics in tournament.statistics.items()}
+	generate_pptx(full_data, full_pv_profiles, args.slot_minutes, mc_team_scores)
 
 
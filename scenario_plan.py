@@ -0,0 +1,259 @@
+# python 3
+#
+# scenario plan of a tournament: the list of scenario draws replayed identically
+# for every team (common random numbers), serialized in a json file
+
+import os
+import json
+import numpy as np
+
+from scenario_store import name_key
+from scenario_reduction import reduce_scenarios
+
+
+# first day of the PV and EV scenario files
+FIRST_DAY = np.datetime64('2014-01-01')
+
+
+def day_months(nb_days):
+    """month (0-11) of the days of the scenario files"""
+    return (FIRST_DAY + np.arange(nb_days)).astype('datetime64[M]').astype(int) % 12
+
+
+# strata of the scenarios: name -> (player type, function of the store giving the label of each scenario)
+STRATA = {
+    # meteorological seasons of the PV day: winter (DJF), spring, summer, autumn
+    'season': ('solar_farm', lambda store: (day_months(store.counts['solar_farm']) + 1) % 12 // 3),
+    'month': ('solar_farm', lambda store: day_months(store.counts['solar_farm'])),
+    'ic_site': ('industrial_consumer', lambda store: np.asarray(store.arrays['ic_site'])),
+    # week days / week-end of the EV day
+    'weekday': ('charging_station',
+                lambda store: ((FIRST_DAY + np.arange(store.counts['charging_station'])).astype(int) + 3) % 7 >= 5),
+}
+
+
+def allocate(shares, nb_draws):
+    """
+    number of draws of each stratum: one each, the others in proportion to
+    their shares (largest remainders)
+    """
+    if nb_draws < len(shares):
+        raise ValueError(f'{nb_draws} draws cannot cover the {len(shares)} strata, use fewer strata or more draws')
+    quotas = shares * (nb_draws - len(shares))
+    allocation = np.floor(quotas).astype(int)
+    remainders = np.argsort(-(quotas - allocation), kind='stable')
+    allocation[remainders[:nb_draws - len(shares) - allocation.sum()]] += 1
+    return allocation + 1
+
+
+class ScenarioPlan:
+    """
+    draws of a tournament: for each draw index, the IC, DC and EV scenarios and
+    the PV day of every region
+
+    draw number i is generated from its own SeedSequence stream (seed, i), so
+    the plan can be extended on demand and the first draws never change.
+    Only the number of scenarios of the store is kept, a plan is cheap to send
+    to worker processes.
+
+    Plans of a sampling design (see stratified and latin_hypercube) have a
+    fixed number of draws, each with the weight of the statistics of its games:
+    the weighted mean of the metrics is an estimate of their mean over the
+    whole scenario store
+    """
+
+    def __init__(self, store, seed=None, draws=None, weights=None, design='random'):
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy)
+        self.seed = seed
+        self.counts = dict(store.counts)
+        self.regions = store.regions
+        self.draws = draws or []
+        self.weights = weights or [1.] * len(self.draws)
+        self.design = design
+
+    def ensure(self, nb_draws):
+        """generate the draws up to nb_draws"""
+        if nb_draws > len(self.draws) and self.design != 'random':
+            raise ValueError(f'the {self.design} plan has {len(self.draws)} draws and cannot be extended to {nb_draws}')
+        for index in range(len(self.draws), nb_draws):
+            self.weights.append(1.)
+            self.draws.append(self.generate_draw(index))
+
+    def generate_draw(self, index):
+        draw_sequence = np.random.SeedSequence(self.seed, spawn_key=(index,))
+        rng = np.random.default_rng(draw_sequence)
+        draw = {player_type: int(rng.integers(self.counts[player_type]))
+                for player_type in ['industrial_consumer', 'data_center', 'charging_station']}
+        draw['solar_farm'] = {}
+        for region in self.regions:
+            region_rng = np.random.default_rng(
+                np.random.SeedSequence(self.seed, spawn_key=(index, name_key(region))))
+            draw['solar_farm'][region] = int(region_rng.integers(self.counts['solar_farm']))
+        return draw
+
+    def game(self, index, region):
+        """scenario indices of the game of draw index in region: {player type: index}"""
+        self.ensure(index + 1)
+        draw = self.draws[index]
+        game = {player_type: draw[player_type] for player_type in ['industrial_consumer', 'data_center', 'charging_station']}
+        game['solar_farm'] = draw['solar_farm'][region]
+        return game
+
+    def weight(self, index):
+        """weight of the games of draw index in the statistics"""
+        self.ensure(index + 1)
+        return self.weights[index]
+
+    @classmethod
+    def stratified(cls, store, seed, nb_draws, strata=('season', 'ic_site')):
+        """
+        stratified sampling: the scenarios are split in the strata given by the
+        combinations of the labels of strata (see STRATA), each stratum gets
+        at least one draw and the others are allocated in proportion to the
+        size of the strata. Within a stratum, the scenarios are drawn uniformly
+        (the PV day independently in each region), and each draw is weighted
+        by the share of its stratum over its number of draws
+        """
+        labels = {}
+        for name in strata:
+            player_type, stratum_labels = STRATA[name]
+            if player_type in labels:
+                raise ValueError(f'strata {name} and {labels[player_type][0]} both stratify the {player_type} scenarios')
+            labels[player_type] = (name, stratum_labels(store))
+        # strata: combinations of the labels of every stratified player type
+        values = {player_type: np.unique(player_labels) for player_type, (_, player_labels) in labels.items()}
+        combinations = np.array(np.meshgrid(*values.values(), indexing='ij')).reshape(len(values), -1).T
+        shares = np.ones(len(combinations))
+        for column, (player_type, (_, player_labels)) in enumerate(labels.items()):
+            frequencies = {value: np.mean(player_labels == value) for value in values[player_type]}
+            shares *= [frequencies[value] for value in combinations[:, column]]
+        allocation = allocate(shares, nb_draws)
+
+        rng = np.random.default_rng(np.random.SeedSequence(seed))
+        draws, weights = [], []
+        for combination, share, nb_stratum_draws in zip(combinations, shares, allocation):
+            candidates = {}
+            for player_type in ['industrial_consumer', 'data_center', 'charging_station', 'solar_farm']:
+                if player_type in labels:
+                    column = list(labels).index(player_type)
+                    candidates[player_type] = np.flatnonzero(labels[player_type][1] == combination[column])
+                else:
+                    candidates[player_type] = np.arange(store.counts[player_type])
+            for _ in range(nb_stratum_draws):
+                draw = {player_type: int(rng.choice(candidates[player_type]))
+                        for player_type in ['industrial_consumer', 'data_center', 'charging_station']}
+                draw['solar_farm'] = {region: int(rng.choice(candidates['solar_farm'])) for region in store.regions}
+                draws.append(draw)
+                weights.append(float(share * nb_draws / nb_stratum_draws))
+        # no stratum comes first, e.g. for the loads of the first draw shown by run.py
+        order = rng.permutation(len(draws))
+        return cls(store, seed, [draws[i] for i in order], [weights[i] for i in order], 'stratified')
+
+    @classmethod
+    def latin_hypercube(cls, store, seed, nb_draws):
+        """
+        latin hypercube design: along each scenario dimension (IC, DC, EV and
+        the PV day of each region), the nb_draws draws fall in nb_draws
+        different intervals of equal size of the scenario indices
+        """
+        def column(sequence, count):
+            rng = np.random.default_rng(sequence)
+            u = (rng.permutation(nb_draws) + rng.random(nb_draws)) / nb_draws
+            return np.minimum((u * count).astype(int), count - 1)
+
+        columns = {player_type: column(np.random.SeedSequence(seed, spawn_key=(i,)), store.counts[player_type])
+                   for i, player_type in enumerate(['industrial_consumer', 'data_center', 'charging_station'])}
+        pv_columns = {region: column(np.random.SeedSequence(seed, spawn_key=(3, name_key(region))),
+                                     store.counts['solar_farm'])
+                      for region in store.regions}
+        draws = []
+        for index in range(nb_draws):
+            draw = {player_type: int(columns[player_type][index]) for player_type in columns}
+            draw['solar_farm'] = {region: int(pv_columns[region][index]) for region in store.regions}
+            draws.append(draw)
+        return cls(store, seed, draws, [1.] * nb_draws, 'latin_hypercube')
+
+    @classmethod
+    def reduced(cls, store, seed, nb_draws=None, nb_scenarios=None):
+        """
+        reduced plan: every combination of the representative scenarios of each
+        player type (see scenario_reduction.reduce_scenarios, nb_scenarios
+        {player type: number of clusters} defaults to REDUCED_SCENARIOS), weighted
+        by the product of the probabilities of their clusters. The weighted mean
+        of the metrics approximates their mean over the whole year; nb_draws is
+        ignored, the plan has the product of the numbers of clusters as draws
+        """
+        nb_scenarios = dict(REDUCED_SCENARIOS, **(nb_scenarios or {}))
+        reductions = {player_type: reduce_scenarios(store, player_type, nb_scenarios[player_type], seed)
+                      for player_type in ['industrial_consumer', 'data_center', 'charging_station', 'solar_farm']}
+        grids = np.meshgrid(*[np.arange(len(reduction['medoids'])) for reduction in reductions.values()],
+                            indexing='ij')
+        combinations = np.array(grids).reshape(len(reductions), -1).T
+        draws, weights = [], []
+        for combination in combinations:
+            draw, weight = {}, float(len(combinations))
+            for (player_type, reduction), cluster in zip(reductions.items(), combination):
+                draw[player_type] = reduction['medoids'][cluster]
+                weight *= reduction['weights'][cluster]
+            # the representative PV day is the same in every region
+            draw['solar_farm'] = {region: draw['solar_farm'] for region in store.regions}
+            draws.append(draw)
+            weights.append(weight)
+        return cls(store, seed, draws, weights, 'reduced')
+
+    @classmethod
+    def full_year(cls, store, seed, nb_draws=None):
+        """
+        one draw per day of the year: draw d plays the PV day d in every region
+        and the EV day d, with IC and DC scenarios drawn from the stream (seed, d).
+        nb_draws is ignored
+        """
+        draws = []
+        for day in range(store.counts['solar_farm']):
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(day,)))
+            draw = {player_type: int(rng.integers(store.counts[player_type]))
+                    for player_type in ['industrial_consumer', 'data_center']}
+            draw['charging_station'] = day % store.counts['charging_station']
+            draw['solar_farm'] = {region: day for region in store.regions}
+            draws.append(draw)
+        return cls(store, seed, draws, [1.] * len(draws), 'full_year')
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'seed': self.seed, 'regions': self.regions, 'design': self.design,
+                       'draws': self.draws, 'weights': self.weights}, f, indent=1)
+
+    @classmethod
+    def load(cls, path, store):
+        with open(path) as f:
+            content = json.load(f)
+        if content['regions'] != store.regions:
+            raise ValueError(f'scenario plan {path} does not match the regions of the scenario files')
+        return cls(store, content['seed'], content['draws'], content.get('weights'), content.get('design', 'random'))
+
+    @classmethod
+    def load_or_create(cls, path, store, seed, nb_draws, design='random', **options):
+        """
+        reuse the plan of path if it exists, else generate it with a sampling
+        design (see SAMPLING_DESIGNS) and save it there. Only random plans are
+        extended to nb_draws, the others keep the draws of their design
+        """
+        if path is not None and os.path.exists(path):
+            plan = cls.load(path, store)
+        elif design == 'random':
+            plan = cls(store, seed)
+        else:
+            plan = getattr(cls, design)(store, seed, nb_draws, **options)
+        if plan.design == 'random':
+            plan.ensure(nb_draws)
+        if path is not None:
+            plan.save(path)
+        return plan
+
+
+# representative scenarios per player type of ScenarioPlan.reduced
+REDUCED_SCENARIOS = {'solar_farm': 6, 'industrial_consumer': 3, 'charging_station': 2, 'data_center': 2}
+
+# sampling designs selectable from run.py ('random' or a ScenarioPlan constructor)
+SAMPLING_DESIGNS = ['random', 'stratified', 'latin_hypercube', 'reduced', 'full_year']
@@ -0,0 +1,113 @@
+# python 3
+#
+# scenario reduction: k-medoids clustering of the daily profiles of the scenario
+# store into a few representative days, with the probability of their cluster
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from scenario_store import default_data_dir, CACHE_DIR_NAME
+
+# bump when the clustering changes, to invalidate the cached reductions
+REDUCTION_VERSION = 1
+
+
+def reduction_profiles(store, player_type):
+    """one row per scenario of player_type, with the profile clustered for it"""
+    if player_type == 'solar_farm':
+        # a PV day is the same calendar day in every region: its profile is the concatenation of the regions
+        pv = np.asarray(store.view('solar_farm'))
+        return pv.transpose(1, 0, 2).reshape(pv.shape[1], -1)
+    profiles = np.asarray(store.view(player_type), dtype=float)
+    # charging station: departure/arrival slots of every car
+    return profiles.reshape(len(profiles), -1)
+
+
+def pairwise_distances(points):
+    """euclidean distance matrix of the rows of points"""
+    squares = np.sum(points**2, axis=1)
+    distances2 = squares[:, None] + squares[None, :] - 2 * points @ points.T
+    return np.sqrt(np.maximum(distances2, 0))
+
+
+def k_medoids(points, k, rng, max_iter=100):
+    """
+    k-medoids clustering (alternating algorithm with a k-medoids++ initialization)
+
+    :param points: array (n x dimension)
+    :param k: number of clusters
+    :param rng: numpy Generator of the initialization
+    :param max_iter: max. number of assignment/update steps
+    :return: returns the (sorted) indices of the k medoids and the cluster of
+    every point (index in the medoids)
+    """
+    n = len(points)
+    if k >= n:
+        return np.arange(n), np.arange(n)
+    distances = pairwise_distances(np.asarray(points, dtype=float))
+
+    medoids = [int(rng.integers(n))]
+    for _ in range(1, k):
+        distances2 = np.min(distances[:, medoids], axis=1)**2
+        if distances2.sum() == 0:
+            candidates = np.setdiff1d(np.arange(n), medoids)
+            medoids.append(int(rng.choice(candidates)))
+        else:
+            medoids.append(int(rng.choice(n, p=distances2 / distances2.sum())))
+    medoids = np.array(medoids)
+
+    for _ in range(max_iter):
+        labels = np.argmin(distances[:, medoids], axis=1)
+        new_medoids = medoids.copy()
+        for cluster in range(k):
+            members = np.flatnonzero(labels == cluster)
+            if len(members) > 0:
+                new_medoids[cluster] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+
+    medoids = np.sort(medoids)
+    labels = np.argmin(distances[:, medoids], axis=1)
+    return medoids, labels
+
+
+def reduction_cache_path(cache_dir, player_type, profiles, k, seed):
+    digest = hashlib.sha1(np.ascontiguousarray(profiles).tobytes())
+    digest.update(json.dumps([REDUCTION_VERSION, player_type, k, seed]).encode())
+    return os.path.join(cache_dir, f'reduction_{player_type}_{k}_{digest.hexdigest()[:16]}.json')
+
+
+def reduce_scenarios(store, player_type, k, seed=0, cache_dir=None):
+    """
+    representative scenarios of player_type: the medoids of k clusters of its
+    daily profiles, and the probability of each cluster (share of the scenarios
+    in it). The reduction is cached as json in cache_dir (scenarios/.cache by
+    default) and recomputed when the profiles change
+
+    :return: returns a dict. with keys "medoids" (scenario indices) and "weights"
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(default_data_dir(), CACHE_DIR_NAME)
+    profiles = reduction_profiles(store, player_type)
+    path = reduction_cache_path(cache_dir, player_type, profiles, k, seed)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+    medoids, labels = k_medoids(profiles, k, np.random.default_rng(np.random.SeedSequence(seed)))
+    reduction = {
+        'medoids': [int(i) for i in medoids],
+        'weights': [float(w) for w in np.bincount(labels, minlength=len(medoids)) / len(profiles)],
+    }
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(reduction, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'could not write scenario reduction cache in {cache_dir}: {e}')
+    return reduction
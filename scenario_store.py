@@ -0,0 +1,439 @@
+# python 3
+#
+# vectorized readers for the scenario files of the scenarios/ folder
+# each csv is parsed once and reshaped straight into numpy arrays, then compiled
+# into a cache of raw .npy files that can be memory-mapped on the next runs
+
+import os
+import json
+import hashlib
+import tempfile
+import shutil
+from multiprocessing import shared_memory
+import numpy as np
+import pandas
+
+
+PV_FILE = os.path.join("solar_farm", "pv_prod_scenarios.csv")
+EV_FILE = os.path.join("charging_station", "ev_scenarios.csv")
+IC_FILE = os.path.join("industrial_consumer", "indus_cons_scenarios.csv")
+DC_FILE = os.path.join("data_center", "data_center_scenarios.csv")
+
+PLAYER_TYPES = ['industrial_consumer', 'solar_farm', 'data_center', 'charging_station']
+
+# number of slots per day in the raw files
+PV_SLOTS = 24
+IC_SLOTS = 48
+DC_SLOTS = 48
+
+# default slot duration of the manager (minutes)
+SLOT_MINUTES = 30
+
+# bump when the layout of the compiled arrays changes
+CACHE_VERSION = 1
+CACHE_DIR_NAME = ".cache"
+MANIFEST_FILE = "manifest.json"
+
+
+def name_key(name):
+    """stable integer key of a name, for the spawn keys of numpy SeedSequence"""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:4], 'little')
+
+
+def default_data_dir():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(this_dir, "scenarios")
+
+
+def read_pv_scenarios(path):
+    """PV production (W/m2) as a (region x day x hourly slot) array, and the region names"""
+    data = pandas.read_csv(path, delimiter=";", usecols=["region", "pv_prod (W/m2)"],
+                           dtype={"region": str, "pv_prod (W/m2)": np.float64}, engine="c")
+    regions = np.array(pandas.unique(data["region"]), dtype=str)
+    pv = data["pv_prod (W/m2)"].to_numpy().reshape(len(regions), -1, PV_SLOTS)
+    return regions, pv
+
+
+def read_ev_scenarios(path):
+    """EV departure/arrival hourly slots as a (day x car x dep/arr) array"""
+    data = pandas.read_csv(path, delimiter=";", usecols=["ev_id", "time_slot_dep", "time_slot_arr"],
+                           dtype={"ev_id": np.int64, "time_slot_dep": np.int64, "time_slot_arr": np.int64},
+                           engine="c")
+    nb_car = int(data["ev_id"].max())
+    ev = data[["time_slot_dep", "time_slot_arr"]].to_numpy().reshape(-1, nb_car, 2)
+    return ev
+
+
+def read_ic_scenarios(path):
+    """industrial consumption (kW) as a (site x scenario x half-hourly slot) array"""
+    data = pandas.read_csv(path, delimiter=";", usecols=["site_id", "cons (kW)"],
+                           dtype={"site_id": np.int64, "cons (kW)": np.float64}, engine="c")
+    nb_site = data["site_id"].nunique()
+    ic = data["cons (kW)"].to_numpy().reshape(nb_site, -1, IC_SLOTS)
+    return ic
+
+
+def read_dc_scenarios(path):
+    """data center consumption (kW) as a (scenario x half-hourly slot) array"""
+    data = pandas.read_csv(path, delimiter=";", usecols=["cons (kW)"],
+                           dtype={"cons (kW)": np.float64}, engine="c")
+    dc = data["cons (kW)"].to_numpy().reshape(-1, DC_SLOTS)
+    return dc
+
+
+def read_scenario_arrays(data_dir=None):
+    """read the four scenario files of data_dir into a dict of arrays"""
+    if data_dir is None:
+        data_dir = default_data_dir()
+    regions, pv = read_pv_scenarios(os.path.join(data_dir, PV_FILE))
+    return {
+        'pv_regions': regions,
+        'pv': pv,
+        'ev': read_ev_scenarios(os.path.join(data_dir, EV_FILE)),
+        'ic': read_ic_scenarios(os.path.join(data_dir, IC_FILE)),
+        'dc': read_dc_scenarios(os.path.join(data_dir, DC_FILE)),
+    }
+
+
+def source_files(data_dir):
+    return {'pv': os.path.join(data_dir, PV_FILE), 'ev': os.path.join(data_dir, EV_FILE),
+            'ic': os.path.join(data_dir, IC_FILE), 'dc': os.path.join(data_dir, DC_FILE)}
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_signature(path, with_hash=True):
+    """size/mtime (and content hash) used to key the compiled cache"""
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        signature['sha1'] = file_hash(path)
+    return signature
+
+
+def read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_cache_valid(manifest, sources):
+    """check the manifest against the source files
+
+    size and mtime are compared first; the content hash is only computed when
+    they differ (e.g. after a fresh git checkout) so that an untouched file
+    does not invalidate the cache
+    """
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return False
+    if set(manifest.get('sources', {})) != set(sources):
+        return False
+    for key, path in sources.items():
+        known = manifest['sources'][key]
+        signature = file_signature(path, with_hash=False)
+        if signature['size'] != known['size']:
+            return False
+        if signature['mtime_ns'] != known['mtime_ns'] and file_hash(path) != known['sha1']:
+            return False
+    return True
+
+
+def refresh_manifest(cache_dir, manifest, sources):
+    """record the new mtime of the source files whose content is unchanged, so they are not hashed again"""
+    stale = False
+    for key, path in sources.items():
+        mtime_ns = os.stat(path).st_mtime_ns
+        if manifest['sources'][key]['mtime_ns'] != mtime_ns:
+            manifest['sources'][key]['mtime_ns'] = mtime_ns
+            stale = True
+    if not stale:
+        return
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        # read-only data folder: the files are hashed again on the next run
+        pass
+
+
+def write_cache(cache_dir, arrays, sources):
+    """write the arrays as .npy files plus a manifest, atomically"""
+    parent = os.path.dirname(os.path.abspath(cache_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".scenario_cache_", dir=parent)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        manifest = {
+            'version': CACHE_VERSION,
+            'sources': {key: file_signature(path) for key, path in sources.items()},
+            'arrays': {name: {'shape': list(array.shape), 'dtype': str(array.dtype)}
+                       for name, array in arrays.items()},
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def read_cache(cache_dir, manifest, mmap_mode="r"):
+    return {name: np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in manifest['arrays']}
+
+
+def load_scenario_arrays(data_dir=None, cache_dir=None, mmap_mode="r"):
+    """load the scenario arrays from the compiled cache, (re)building it if needed
+
+    the arrays are memory-mapped read-only by default: loading them skips the
+    csv parsing, but the conversion to the time step of the manager (see
+    build_manager_arrays) still reads them in full
+    """
+    if data_dir is None:
+        data_dir = default_data_dir()
+    if cache_dir is None:
+        cache_dir = os.path.join(data_dir, CACHE_DIR_NAME)
+    sources = source_files(data_dir)
+
+    manifest = read_manifest(cache_dir)
+    if not is_cache_valid(manifest, sources):
+        arrays = read_scenario_arrays(data_dir)
+        try:
+            write_cache(cache_dir, arrays, sources)
+        except OSError as e:
+            # read-only data folder: keep going with the parsed arrays
+            print(f'could not write scenario cache in {cache_dir}: {e}')
+            return arrays
+        manifest = read_manifest(cache_dir)
+    else:
+        refresh_manifest(cache_dir, manifest, sources)
+    return read_cache(cache_dir, manifest, mmap_mode)
+
+
+def read_national_grid_prices(path):
+    """read the purchase/sale prices of the national grid"""
+    prices_data = pandas.read_csv(path, header=None, delimiter=" ")
+    prices = prices_data.iloc[0].to_numpy()
+    return {'purchase': prices, 'sale':prices.copy()}
+
+
+def resample_slots(profiles, from_minutes, to_minutes):
+    """
+    resample profiles with time-slots on the last axis: values are repeated on
+    finer slots and averaged on coarser ones (powers in kW or W/m2, prices)
+    """
+    profiles = np.asarray(profiles)
+    if to_minutes <= from_minutes:
+        if from_minutes % to_minutes:
+            raise ValueError(f'{from_minutes} min. slots cannot be split in {to_minutes} min. slots')
+        return np.repeat(profiles, from_minutes // to_minutes, axis=-1)
+    factor = to_minutes // from_minutes
+    if to_minutes % from_minutes or profiles.shape[-1] % factor:
+        raise ValueError(f'{profiles.shape[-1]} slots of {from_minutes} min. cannot be grouped in {to_minutes} min. slots')
+    return profiles.reshape(profiles.shape[:-1] + (-1, factor)).mean(axis=-1)
+
+
+def build_manager_arrays(raw, slot_minutes=SLOT_MINUTES):
+    """convert the raw scenario arrays to the time step of the manager (half-hourly by default)"""
+    return {
+        # STATION DE RECHARGE : horaires de depart/arrivee, convertis du pas horaire au pas du manager
+        'charging_station': raw['ev'] * 60 // slot_minutes,
+        # FERME SOLAIRE : production horaire repetee (ou moyennee) sur les pas du manager
+        'solar_farm': resample_slots(raw['pv'], 24*60 // PV_SLOTS, slot_minutes),
+        'pv_regions': np.asarray(raw['pv_regions']),
+        # COMPLEXE INDUSTRIEL : les scenarios des differents sites sont mis bout a bout
+        'industrial_consumer': resample_slots(raw['ic'].reshape(-1, raw['ic'].shape[-1]) / 10.,
+                                              24*60 // IC_SLOTS, slot_minutes),
+        # site of each scenario of the industrial consumer
+        'ic_site': np.repeat(np.arange(raw['ic'].shape[0]), raw['ic'].shape[1]),
+        # DATA CENTER
+        'data_center': resample_slots(raw['dc'], 24*60 // DC_SLOTS, slot_minutes),
+    }
+
+
+def resample_prices(prices, slot_minutes=SLOT_MINUTES):
+    """national grid prices (half-hourly in the price file) at the time step of the manager"""
+    return {name: resample_slots(price, 24*60 // len(price), slot_minutes) for name, price in prices.items()}
+
+
+def read_only(array):
+    array = np.asarray(array)
+    if array.flags.writeable:
+        array = array.view()
+        array.flags.writeable = False
+    return array
+
+
+class ScenarioStore:
+    """immutable scenarios and prices, loaded once and shared by every Manager of a process
+
+    arrays are at the time step of the manager (see build_manager_arrays and
+    slot_minutes) and scenarios are integer indices along their first axis:
+    - store.get("charging_station", i) --> (car x dep/arr) slots of day i
+    - store.get("solar_farm", i, region) --> PV production of day i in region
+    - store.get("industrial_consumer", i) --> consumption of scenario i (all sites)
+    - store.get("data_center", i) --> consumption of scenario i
+    """
+
+    def __init__(self, arrays, prices, shared_blocks=None):
+        self.arrays = {name: read_only(array) for name, array in arrays.items()}
+        self.prices = {name: read_only(price) for name, price in prices.items()}
+        self.region_indices = {str(region): i for i, region in enumerate(self.arrays['pv_regions'])}
+        self.counts = {player_type: self.arrays[player_type].shape[1 if player_type == 'solar_farm' else 0]
+                       for player_type in PLAYER_TYPES}
+        # shared memory blocks backing the arrays, kept alive with the store
+        self._shared_blocks = shared_blocks or []
+
+    @property
+    def regions(self):
+        return list(self.region_indices)
+
+    @property
+    def slot_minutes(self):
+        """duration of the time-slots of the arrays"""
+        return 24*60 // self.arrays['solar_farm'].shape[-1]
+
+    def view(self, player_type, region=None):
+        """zero-copy (scenario x ...) array of a player type"""
+        if player_type == 'solar_farm' and region is not None:
+            return self.arrays[player_type][self.region_indices[region]]
+        return self.arrays[player_type]
+
+    def get(self, player_type, index, region=None):
+        """scenario number index of a player type (a read-only view)"""
+        if player_type == 'solar_farm':
+            return self.arrays[player_type][self.region_indices[region], index]
+        return self.arrays[player_type][index]
+
+    def draw_index(self, player_type, rng):
+        """draw one scenario index of a player type with a numpy Generator"""
+        return int(rng.integers(self.counts[player_type]))
+
+    def draw(self, n, rng):
+        """draw n scenarios at once, as a dict player type -> array of n indices"""
+        return {player_type: rng.integers(self.counts[player_type], size=n) for player_type in PLAYER_TYPES}
+
+    @classmethod
+    def load(cls, path_to_price_file, data_dir=None, cache_dir=None, slot_minutes=SLOT_MINUTES):
+        raw = load_scenario_arrays(data_dir, cache_dir)
+        return cls(build_manager_arrays(raw, slot_minutes),
+                   resample_prices(read_national_grid_prices(path_to_price_file), slot_minutes))
+
+    def publish(self, directory=None):
+        """copy the store into shared memory blocks (or .npy files of directory)
+
+        returns a SharedScenarioStore, whose picklable handle can be sent to
+        worker processes to attach to the store without copying it
+        """
+        return SharedScenarioStore(self, directory)
+
+    @classmethod
+    def attach(cls, handle):
+        """read-only, zero-copy store on the data published by SharedScenarioStore"""
+        arrays, prices, blocks = {}, {}, []
+        for group, target in (('arrays', arrays), ('prices', prices)):
+            for name, spec in handle[group].items():
+                if handle['kind'] == 'shm':
+                    block = attach_shared_memory(spec['name'])
+                    blocks.append(block)
+                    target[name] = np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=block.buf)
+                else:
+                    target[name] = np.load(spec['path'], mmap_mode="r")
+        return cls(arrays, prices, blocks)
+
+    def close(self):
+        """release the shared memory blocks this store is attached to"""
+        self.arrays, self.prices = {}, {}
+        for block in self._shared_blocks:
+            block.close()
+        self._shared_blocks = []
+
+
+def attach_shared_memory(name):
+    """open an existing shared memory block, leaving its ownership to the publisher"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13: the block is registered again, but child processes share
+        # the resource tracker of the publishing process, which unlinks it once
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedScenarioStore:
+    """a ScenarioStore published in shared memory, or in memory-mapped .npy files
+
+    the publishing process owns the data: close() (or leaving the with block)
+    must be called once all the workers are done
+    """
+
+    def __init__(self, store, directory=None):
+        self._blocks = []
+        self.directory = directory
+        self.handle = {'kind': 'shm' if directory is None else 'mmap', 'arrays': {}, 'prices': {}}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            for group, arrays in (('arrays', store.arrays), ('prices', store.prices)):
+                for name, array in arrays.items():
+                    self.handle[group][name] = self._publish_array(f"{group}_{name}", array)
+        except BaseException:
+            self.close()
+            raise
+
+    def _publish_array(self, name, array):
+        array = np.ascontiguousarray(array)
+        if self.directory is not None:
+            path = os.path.join(self.directory, f"{name}.npy")
+            np.save(path, array)
+            return {'path': path}
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return {'name': block.name, 'shape': array.shape, 'dtype': array.dtype.str}
+
+    def attach(self):
+        return ScenarioStore.attach(self.handle)
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+        if self.directory is not None:
+            for group in ('arrays', 'prices'):
+                for spec in self.handle[group].values():
+                    if os.path.exists(spec['path']):
+                        os.remove(spec['path'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# process-wide stores, keyed by the files they were read from and their slot duration
+_stores = {}
+
+
+def get_scenario_store(path_to_price_file, data_dir=None, slot_minutes=SLOT_MINUTES):
+    """return the store of this process for these files and resolution, loading it on first use"""
+    if data_dir is None:
+        data_dir = default_data_dir()
+    key = (os.path.abspath(path_to_price_file), os.path.abspath(data_dir), slot_minutes)
+    if key not in _stores:
+        _stores[key] = ScenarioStore.load(path_to_price_file, data_dir, slot_minutes=slot_minutes)
+    return _stores[key]
@@ -1,37 +1,104 @@
 # python 3
 import json
+import copy
 import numpy as np
 import random
-import os
 from collections import defaultdict
-import pandas
 import tqdm
 import sys
 
+from scenario_store import get_scenario_store, name_key, SLOT_MINUTES
+from calc_output_metrics import calculate_bills, calc_game_metrics
+from coordination import StoppingCriteria, GradientStep
+from monte_carlo import new_region_statistics, record_metrics
+from player_batch import ScalarPlayerAdapter, batch_player, broadcast_prices
+from player_execution import SerialBackend, ThreadBackend, ProcessBackend
+from player_sandbox import PlayerProxy
+from player_cache import MemoizedPlayer, is_pure, unwrap
+
 
 class Manager:
-    def __init__(self, team_name: str, path_to_player_file, path_to_price_file, regions):
+    def __init__(self, team_name: str, path_to_player_file, path_to_price_file, regions,
+                 store=None, teams=None, seed=None, stopping=None,
+                 price_update=None, warm_start=None, plan=None, slot_minutes=SLOT_MINUTES,
+                 player_backend=None, sandbox=None, failure_penalty=1000., response_cache=None):
         self.horizon = 24
-        self.dt = 0.5
+        # time-slot duration (h): 60, 30 (default), 15, 5 minutes...
+        self.dt = slot_minutes / 60
         self.nbr_iterations = 10
-        self.nb_pdt = int(self.horizon/self.dt)
+        self.nb_pdt = int(self.horizon*60 // slot_minutes)
 
         self.regions = regions
         self.team_name = team_name
         self.path_to_player_file = path_to_player_file
 
-        self.players = self.create_players(team_name, path_to_player_file)
-        self.scenarios = self.read_all_scenarios()
-        self.external_prices = self.read_national_grid_prices(path_to_price_file)
+        # scenarios and prices are read once per process and shared by all the managers
+        if store is None:
+            store = get_scenario_store(path_to_price_file, slot_minutes=slot_minutes)
+        if store.slot_minutes != slot_minutes:
+            raise ValueError(f'the scenario store has {store.slot_minutes} min. slots, not {slot_minutes}')
+        self.store = store
+
+        # player_sandbox.SandboxLimits to host each player in its own worker process (see new_player)
+        self.sandbox = sandbox
+        # score penalty (eur) of each failed call of a sandboxed player
+        self.failure_penalty = failure_penalty
+        self.players = self.create_players(team_name, path_to_player_file, teams)
+        # player_cache.ResponseCache memoizing the loads of the players declaring themselves pure
+        self.response_cache = response_cache
+        if response_cache is not None:
+            self.players = [MemoizedPlayer(player, response_cache) if is_pure(player) else player
+                            for player in self.players]
+        # batched protocol of each player, natively or through the scalar API (see player_batch)
+        self.batch_players = [batch_player(player) for player in self.players]
+        self.external_prices = store.prices
+
+        # root of the random streams of the team: every (scenario, region) game gets its own
+        # Generator (see game_seed_sequences), so any game can be replayed on its own
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (name_key(team_name),))
+        self.nb_draws = 0
+        # scenario_plan.ScenarioPlan shared by all the teams (common random numbers), if any
+        self.plan = plan
 
         self.__results = defaultdict(dict)
         self.scenarios_per_actor = {}
-
-    def create_players(self, team_name: str, json_file):
+        self.pv_day = None
+
+        # early stopping of the coordination loop, and per region trace of the residuals
+        if stopping is None:
+            stopping = StoppingCriteria()
+        self.stopping = stopping
+        self.convergence = {}
+        # prices at the end of the last game of each region, see roll
+        self.final_prices = {}
+
+        # per region running mean/variance of the metrics of every game played (see record_game)
+        self.statistics = defaultdict(new_region_statistics)
+
+        # price update of the coordination loop (see coordination.PRICE_UPDATES)
+        if price_update is None:
+            price_update = GradientStep()
+        self.price_update = price_update
+
+        # coordination.PriceCache seeding each game with the prices of the closest game already played
+        self.warm_start = warm_start
+
+        # execution of the players of an iteration (see player_execution.PLAYER_BACKENDS)
+        if player_backend is None:
+            player_backend = SerialBackend()
+        if sandbox is not None and isinstance(player_backend, ProcessBackend):
+            # sandboxed players already run in their own processes (and cannot be pickled): only their calls are concurrent
+            player_backend = ThreadBackend(player_backend.workers)
+        self.player_backend = player_backend
+
+    def create_players(self, team_name: str, json_file, teams=None):
         """initialize all players"""
 
-        with open(json_file) as f:
-            teams = json.load(f)
+        if teams is None:
+            with open(json_file) as f:
+                teams = json.load(f)
 
         new_players = []
 
@@ -44,175 +111,216 @@ class Manager:
                 player = {}
                 player['team'] = team_name
                 player['type'] = player_type
-                mod = __import__(f"players.{team_name}.player_{player_type}", fromlist=["Player"])
-                new_player = mod.Player()
+                new_player = self.new_player(f"players.{team_name}.player_{player_type}")
                 new_player.__manager__data = player
                 new_players.append(new_player)
         elif isinstance(team, list):
             players = team
             for player in players:
                 player['team'] = team_name
-                mod = __import__(f"players.{team_name}.{player['folder']}.player", fromlist=["Player"])
-                new_player = mod.Player()
+                new_player = self.new_player(f"players.{team_name}.{player['folder']}.player")
                 new_player.__manager__data = player
                 new_players.append(new_player)
 
-        return new_players
-
-    def read_national_grid_prices(self, path):
-        """initialize daily scenarios"""
-        prices_data = pandas.read_csv(path, header=None, delimiter=" ")
-        prices = prices_data.iloc[0].to_numpy()
-        return {'purchase': prices, 'sale':prices.copy()}
+        for new_player in new_players:
+            self.set_player_time_step(new_player)
 
-    def read_all_scenarios(self):
-        """initialize daily scenarios"""
+        return new_players
 
-        this_dir = os.path.dirname(os.path.abspath(__file__))
-        data_dir = os.path.join(this_dir, "scenarios")
-        # les scenarios pour chaque type de player
-        scenario = {}
+    def new_player(self, module_name):
+        """instance of the Player of module_name, in its own worker process if sandboxed"""
+        if self.sandbox is not None:
+            return PlayerProxy(module_name, self.sandbox)
+        mod = __import__(module_name, fromlist=["Player"])
+        return mod.Player()
 
-        for player_type in ['industrial_consumer', 'data_center', 'solar_farm', 'charging_station']:
-            if player_type == "charging_station":
-                
-                #STATION DE RECHARGE
-                car_data=pandas.read_csv(os.path.join(data_dir, "charging_station", "ev_scenarios.csv"), delimiter =";")
-                nb_car=10
-                charging_station={}
-                for day in range (365):
-                    day_name="scenario_"+str(day)
-                    day_data={}
-                    for car in range (10):
-                        car_name="car_"+str(car)
-                        car_dep_arr=[car_data["time_slot_dep"][10*day+car]*2,car_data["time_slot_arr"][10*day+car]*2]
-                        day_data[car_name]=car_dep_arr
-                    charging_station[day_name]=list(day_data.values())
-                scenario[player_type]=charging_station
-
-                #================================================================================================================================================================
-                # pour acceder aux horaires de départ et d'arrivée d'une voiture pendant une journée : scenario["charging_station"]["scenario_i"]["car_j"]  --> renvoie une liste
-                #================================================================================================================================================================
-
-            elif player_type == "solar_farm":
-                
-                # FERME SOLAIRE
-                solar_data=pandas.read_csv(os.path.join(data_dir, "solar_farm", "pv_prod_scenarios.csv"), delimiter =";")
-                # 8 régions, 365 jours, 24 heures
-                scenario_solar={}
-                for region in range (8):
-                    region_name = solar_data['region'][8760*region]
-                    reg={} 
-                    for jour in range (365):
-                        day_name = "scenario_"+str(jour)
-                        list_day = []
-                        for heure in range (24):
-                            list_day.append(solar_data["pv_prod (W/m2)"][8760*region+24*jour+heure])
-                            list_day.append(solar_data["pv_prod (W/m2)"][8760*region+24*jour+heure])
-                        reg[day_name]=list_day
-                    scenario_solar[region_name]=reg
-                scenario[player_type]=scenario_solar
-
-
-                #======================================================================================================
-                # pour acceder à une journée : scenario["solar_farm"]["region_i"]["scenario_j"]  --> renvoie une liste
-                #======================================================================================================
-
-            elif player_type == "industrial_consumer":
-                
-                # COMPLEXE INDUSTRIEL
-                industrial_data=pandas.read_csv(os.path.join(data_dir,
-                                                             "industrial_consumer", "indus_cons_scenarios.csv"), delimiter =";")
-                nb_scenarios=0
-                for i in industrial_data.index:
-                    if(industrial_data["time_slot"][i]==1):
-                        nb_scenarios+=1
-                scenario_industrial={}
-                for i in range (nb_scenarios):
-                    nom_scenario="scenario_"+str(i)
-                    list_scenario=[]
-                    for j in range (48):
-                        list_scenario.append(np.array(industrial_data["cons (kW)"][48*i+j])/10.)
-                    scenario_industrial[nom_scenario]=list_scenario
-                scenario[player_type]=scenario_industrial
-
-                #===============================================================================================
-                # pour acceder à une journée : scenario["industrial_farm"]["scenario_i"]  --> renvoie une liste
-                #===============================================================================================
-            elif player_type == "data_center":
-                                 
-                #DATA CENTER
-                dcenter_data=pandas.read_csv(os.path.join(data_dir,"data_center", "data_center_scenarios.csv" ),delimiter = ";")
-                data_center={}
-                for scenar in range(10):
-                    list_scenar=[]
-                    scenar_name="scenario_"+str(scenar)
-                    for time in range(48):
-                        list_scenar.append(dcenter_data["cons (kW)"][10*scenar+time])
-                    data_center[scenar_name]=list_scenar
-                scenario["data_center"]=data_center
-
-                #================================================================================================
-                # pour acceder à un scenario : scenario["data_center"]["scenario_i"]  --> renvoie une liste
-                #================================================================================================
+    def player_failures(self):
+        """number of failed calls of the sandboxed players so far"""
+        return sum(getattr(player, 'failed_calls', 0) for player in self.players)
 
-        return scenario
+    def player_usage(self):
+        """calls, failures and resources used by each sandboxed player, by player type"""
+        return {player.__manager__data['type']: dict(unwrap(player).usage)
+                for player in self.players if isinstance(unwrap(player), PlayerProxy)}
 
-    def initialize_prices(self):
+    def close(self):
+        """stop the worker processes of the sandboxed players and of the player backend"""
+        for player in self.players:
+            if isinstance(unwrap(player), PlayerProxy):
+                unwrap(player).close()
+        self.player_backend.close()
+
+    def set_player_time_step(self, player):
+        """give the time step of the manager to a player, through set_time_step or its dt attribute"""
+        if hasattr(player, 'set_time_step'):
+            player.set_time_step(self.dt)
+        elif hasattr(player, 'dt'):
+            player.dt = self.dt
+
+    def initialize_prices(self, scenario=None, region=None):
         """initialize daily prices"""
+        if self.warm_start is not None and scenario is not None:
+            prices = self.warm_start.lookup(self.team_name, self.non_pv_scenarios(), region, self.pv_day,
+                                            scenario['solar_farm'])
+            if prices is not None and len(prices['purchase']) == self.nb_pdt:
+                return prices
         purchase_prices = np.zeros(self.nb_pdt)
         sale_prices = np.zeros(self.nb_pdt)
         return {"purchase": purchase_prices, "sale": sale_prices}
 
-    def draw_random_scenario(self, region):
-        """ Draw a scenario for the day """
+    def game_seed_sequences(self, index, region):
+        """seed sequences of the (IC, DC, EV) draw number index, and of its game in region"""
+        draw = np.random.SeedSequence(self.seed_sequence.entropy,
+                                      spawn_key=self.seed_sequence.spawn_key + (index,))
+        game = np.random.SeedSequence(draw.entropy, spawn_key=draw.spawn_key + (name_key(region),))
+        return draw, game
+
+    def prepare_game(self, index, region, scenario=None):
+        """scenario of the game of draw number index in region
+
+        with a scenario plan, the game is read from the plan (same draws for
+        every team); else the (IC, DC, EV) scenarios are drawn from the stream of
+        the draw (unless scenario is given) and the PV day from the stream of the game
+        """
+        draw, game = self.game_seed_sequences(index, region)
+        if self.plan is not None:
+            scenario = self.set_game(self.plan.game(index, region), region)
+        else:
+            if scenario is None:
+                scenario = self.draw_random_scenario(region, np.random.default_rng(draw))
+            scenario = self.switch_region(scenario, region, np.random.default_rng(game))
+        # players drawing from the global generators get a per-game state too
+        self.seed_players(game)
+        return scenario
+
+    def seed_players(self, sequence):
+        """seed the global generators used by the players from a numpy SeedSequence"""
+        state = sequence.generate_state(2)
+        random.seed(int(state[1]))
+        np.random.seed(int(state[0]))
+        for player in self.players:
+            # sandboxed players draw from the generators of their worker process
+            if isinstance(unwrap(player), PlayerProxy):
+                unwrap(player).seed(int(state[0]), int(state[1]))
+
+    def prepare_games(self, index, regions):
+        """scenarios {region: scenario} of draw number index, and the PV day of each region (see play_lockstep)"""
+        games, pv_days = {}, {}
+        scenario = None
+        for region in regions:
+            scenario = self.prepare_game(index, region, scenario)
+            # switch_region updates the scenario in place
+            games[region] = dict(scenario)
+            pv_days[region] = self.pv_day
+        # the games of the draw share the generators: seeded by the draw, not by the order of the regions
+        self.seed_players(self.game_seed_sequences(index, regions[0])[0])
+        return games, pv_days
+
+    def set_game(self, game, region):
+        """scenario of the game given by its scenario indices {player type: index}"""
         scenario = {}
-        for player_type in ['industrial_consumer', 'solar_farm', 'data_center', 'charging_station']:
+        for player_type, id_scenario in game.items():
             if player_type == "solar_farm":
-                id_scenario = random.choice(list(self.scenarios[player_type][region].keys()))
-                random_scenario = self.scenarios[player_type][region][id_scenario]
-                scenario[player_type] = random_scenario
-                self.scenarios_per_actor[player_type] = region # int(id_scenario.split('_')[-1])
-            elif player_type in ["charging_station", 'industrial_consumer', 'data_center']:
-                id_scenario = random.choice(list(self.scenarios[player_type].keys()))
-                random_scenario = self.scenarios[player_type][id_scenario]
-                scenario[player_type] = random_scenario
-                self.scenarios_per_actor[player_type] = id_scenario # int(id_scenario.split('_')[-1])
+                scenario[player_type] = self.store.get(player_type, id_scenario, region)
+                self.scenarios_per_actor[player_type] = region
+                self.pv_day = id_scenario
+            else:
+                scenario[player_type] = self.store.get(player_type, id_scenario)
+                self.scenarios_per_actor[player_type] = id_scenario
         return scenario
 
-    def switch_region(self, scenario, region):
-        id_scenario = random.choice(list(self.scenarios['solar_farm'][region].keys()))
-        random_scenario = self.scenarios['solar_farm'][region][id_scenario]
-        scenario['solar_farm'] = random_scenario
-        self.scenarios_per_actor['solar_farm'] = region  # int(id_scenario.split('_')[-1])
+    def draw_random_scenario(self, region, rng):
+        """ Draw a scenario for the day """
+        game = {player_type: self.store.draw_index(player_type, rng)
+                for player_type in ['industrial_consumer', 'solar_farm', 'data_center', 'charging_station']}
+        return self.set_game(game, region)
+
+    def switch_region(self, scenario, region, rng):
+        id_scenario = self.store.draw_index('solar_farm', rng)
+        scenario['solar_farm'] = self.store.get('solar_farm', id_scenario, region)
+        self.scenarios_per_actor['solar_farm'] = region
+        self.pv_day = id_scenario
         return scenario
 
+    def non_pv_scenarios(self):
+        """(IC, DC, EV) scenario indices of the current draw"""
+        return tuple(self.scenarios_per_actor[player_type]
+                     for player_type in ['industrial_consumer', 'data_center', 'charging_station'])
+
     def get_microgrid_load(self):
         """ Compute the energy balance on a slot """
         microgrid_load = np.zeros(self.nb_pdt)
         loads = {}
 
-        for player in self.players:
-            load = player.compute_all_load()
-
+        # the players may run concurrently, their loads are all gathered before going on
+        player_loads = self.player_backend.compute_loads(self.players)
+        for player, load in zip(self.players, player_loads):
             microgrid_load += load
             # storing loads for each player for future backup
             loads[player.__manager__data['type']] = load
 
         return microgrid_load, loads
 
+    def evaluate_batch(self, prices, scenarios):
+        """ Compute the loads and bills of many (prices, scenario) pairs at once
+
+        prices are a dict. of (k x nb_pdt) arrays (or of nb_pdt arrays, shared by
+        the k evaluations) and scenarios a list of k scenarios, or a single one.
+        Each evaluation starts from the reset players. Returns the (k x nb_pdt)
+        microgrid loads, the (k x nb_pdt) loads of each player type, the k
+        microgrid bills and the (k) bills of each player type
+        """
+        if isinstance(scenarios, dict):
+            k = len(prices['purchase']) if np.ndim(prices['purchase']) == 2 else 1
+            scenarios = [scenarios] * k
+        prices = broadcast_prices(prices, len(scenarios), self.nb_pdt)
+        loads = {}
+        for player, batch in zip(self.players, self.batch_players):
+            player_type = player.__manager__data['type']
+            player_scenarios = [scenario.get(player_type) for scenario in scenarios]
+            player_loads = batch.compute_all_load_batch(prices, player_scenarios)
+            if player_loads is None:
+                # failed call of a sandboxed player
+                player_loads = np.zeros((len(scenarios), self.nb_pdt))
+            loads[player_type] = np.asarray(player_loads, dtype=float)
+        microgrid_loads = np.sum(list(loads.values()), axis=0)
+
+        player_types = list(loads)
+        load_matrix = np.stack([microgrid_loads] + [loads[player_type] for player_type in player_types])
+        bills = calculate_bills(load_matrix, prices["purchase"], prices["sale"], self.dt*3600)
+        player_bills = {player_type: bills[i + 1] for i, player_type in enumerate(player_types)}
+        return microgrid_loads, loads, bills[0], player_bills
+
+    @property
+    def batched(self):
+        """
+        whether every player implements the batched protocol, the games of a
+        draw are then played by play_lockstep (a scalar player, possibly
+        stateful across iterations, keeps the loop of play)
+        """
+        return all(not isinstance(batch, ScalarPlayerAdapter) for batch in self.batch_players)
+
     def compute_bills(self, microgrid_load, loads, prices):
         """ Compute the bill of each players """
-        microgrid_bill = 0
-        player_bills = defaultdict(float)
-        for i in range (self.nb_pdt):
-            microgrid_bill += microgrid_load[i]*prices.get("purchase")[i]
-            for j in range(len(self.players)):
-                player = self.players[j]
-                for i in range (self.nb_pdt):
-                    player_bills[player.__manager__data['type']] += prices.get("purchase")[i]*loads[player.__manager__data['type']][i]
+        # purchase prices apply to positive flows and sale prices to negative ones
+        player_types = list(loads)
+        load_matrix = np.vstack([microgrid_load] + [loads[player_type] for player_type in player_types])
+        bills = calculate_bills(load_matrix, prices["purchase"], prices["sale"], self.dt*3600)
+        microgrid_bill = float(bills[0])
+        player_bills = {player_type: float(bill) for player_type, bill in zip(player_types, bills[1:])}
         return microgrid_bill, player_bills
 
+    def export_player_states(self):
+        """state of the players implementing get_state (e.g. storage levels), by player type"""
+        return {player.__manager__data['type']: player.get_state()
+                for player in self.players if hasattr(player, 'get_state')}
+
+    def import_player_states(self, states):
+        """give back to the players implementing set_state the state exported by export_player_states"""
+        for player in self.players:
+            if hasattr(player, 'set_state') and player.__manager__data['type'] in states:
+                player.set_state(states[player.__manager__data['type']])
+
     def send_prices_to_players(self, prices):
         for player in self.players:
             # TODO: a remplacer
@@ -230,38 +338,124 @@ class Manager:
                     raise e
             pass
 
-    def play(self, scenario, region):
-        """ Playing one party """
+    def play(self, scenario, region, player_states=None, initial_prices=None):
+        """ Playing one party
+
+        player_states (see export_player_states) are given to the players after
+        their reset and scenario, and the coordination starts from initial_prices
+        if given: this chains consecutive days in roll
+        """
+        failures = self.player_failures()
         self.reset()
         # initialisation de la boucle de coordination
         self.send_scenario_to_players(scenario)
-        prices = self.initialize_prices()
+        if player_states is not None:
+            self.import_player_states(player_states)
+        if initial_prices is not None:
+            prices = {name: np.array(initial_prices[name], dtype=float) for name in ('purchase', 'sale')}
+        else:
+            prices = self.initialize_prices(scenario, region)
+        self.price_update.reset()
+        self.stopping.start()
+        self.__results[region] = {}
+        trace = []
+        reason = None
         # debut de la coordination
         for iteration in range(self.nbr_iterations):  # main loop
             self.send_prices_to_players(prices)
             microgrid_load, player_loads = self.get_microgrid_load()
             microgrid_bill, player_bills = self.compute_bills(microgrid_load, player_loads, prices)
+            new_prices, converged = self.get_next_prices(iteration, prices, microgrid_load)
+            reason, residuals = self.stopping.check(prices, new_prices, microgrid_load, microgrid_bill)
+            trace.append(residuals)
             self.store_results(region, iteration,
                                {
                                    'scenario': scenario,
                                    'player_loads': player_loads,
                                    'player_bills': player_bills,
                                    'microgrid_load': microgrid_load,
-                                   'microgrid_bill': microgrid_bill
+                                   'microgrid_bill': microgrid_bill,
+                                   'residuals': residuals
                                }
                                )
-            prices, converged = self.get_next_prices(iteration, prices, microgrid_load)
+            prices = new_prices
             if converged:
+                reason = 'converged'
+            if reason is not None:
                 break
+        self.convergence[region] = {'iterations': len(trace), 'reason': reason, 'trace': trace,
+                                    'failures': self.player_failures() - failures}
+        self.final_prices[region] = prices
+        if self.warm_start is not None:
+            self.warm_start.add(self.team_name, self.non_pv_scenarios(), region, self.pv_day,
+                                scenario['solar_farm'], prices)
+
+    def play_lockstep(self, games, pv_days):
+        """ Playing the games of one draw in several regions at once
+
+        games are the scenarios of the regions and pv_days their PV days (see
+        prepare_games). The coordination loops of the regions run side by side,
+        each with its own copy of the price update and stopping criteria: at
+        each iteration, every player evaluates the prices of all the regions
+        still playing in one call of the batched protocol (see evaluate_batch).
+        Every player is natively batched (see batched), the generators they
+        share are seeded once for the draw, and the failed calls of a batch
+        count in every region of the batch
+        """
+        regions = list(games)
+        prices, price_updates, stoppings, traces, reasons, failures = {}, {}, {}, {}, {}, {}
+        for region in regions:
+            self.pv_day = pv_days[region]
+            prices[region] = self.initialize_prices(games[region], region)
+            price_updates[region] = copy.deepcopy(self.price_update)
+            price_updates[region].reset()
+            stoppings[region] = copy.deepcopy(self.stopping)
+            stoppings[region].start()
+            self.__results[region] = {}
+            traces[region] = []
+            reasons[region] = None
+            failures[region] = 0
+        active = regions
+        for iteration in range(self.nbr_iterations):
+            batch_failures = self.player_failures()
+            microgrid_loads, loads, microgrid_bills, player_bills = self.evaluate_batch(
+                {name: np.array([prices[region][name] for region in active]) for name in ('purchase', 'sale')},
+                [games[region] for region in active])
+            batch_failures = self.player_failures() - batch_failures
+            still_active = []
+            for k, region in enumerate(active):
+                failures[region] += batch_failures
+                new_prices = price_updates[region].next_prices(iteration, prices[region], microgrid_loads[k])
+                reason, residuals = stoppings[region].check(prices[region], new_prices, microgrid_loads[k],
+                                                            float(microgrid_bills[k]))
+                traces[region].append(residuals)
+                self.store_results(region, iteration,
+                                   {
+                                       'scenario': games[region],
+                                       'player_loads': {player_type: load[k] for player_type, load in loads.items()},
+                                       'player_bills': {player_type: float(bills[k]) for player_type, bills in player_bills.items()},
+                                       'microgrid_load': microgrid_loads[k],
+                                       'microgrid_bill': float(microgrid_bills[k]),
+                                       'residuals': residuals
+                                   }
+                                   )
+                prices[region] = new_prices
+                if reason is None:
+                    still_active.append(region)
+                reasons[region] = reason
+            active = still_active
+            if not active:
+                break
+        for region in regions:
+            self.convergence[region] = {'iterations': len(traces[region]), 'reason': reasons[region],
+                                        'trace': traces[region], 'failures': failures[region]}
+            self.final_prices[region] = prices[region]
+            if self.warm_start is not None:
+                self.warm_start.add(self.team_name, self.non_pv_scenarios(), region, pv_days[region],
+                                    games[region]['solar_farm'], prices[region])
 
     def get_next_prices(self, iteration, prices, microgrid_load):
-        old_purchase = prices.get("purchase")
-        old_sale = prices.get("sale")
-        grad = microgrid_load - np.mean(microgrid_load)
-        dp = 1e-3 * 0.99**iteration
-        purchase_prices = old_purchase + dp * grad
-        sale_prices = old_sale + dp * grad
-        new_prices = dict(purchase=purchase_prices, sale=sale_prices)
+        new_prices = self.price_update.next_prices(iteration, prices, microgrid_load)
         return new_prices, False
 
     def store_results(self, simulation, iteration, data):
@@ -273,21 +467,130 @@ class Manager:
             player.reset()
 
     def simulate(self, nb_simulation, simulation_name):
-        # for each simulation
-        scenario = self.draw_random_scenario(self.regions[0])
+        """play nb_simulation independent (IC, DC, EV) draws in every region
+
+        the loads of the first draw are returned for visualization, while the
+        metrics of every game are aggregated in self.statistics. With
+        nb_simulation None, the remaining draws of the scenario plan are played
+        (e.g. every representative day of ScenarioPlan.reduced, whose weighted
+        statistics approximate the full year)
+        """
+        if nb_simulation is None:
+            if self.plan is None:
+                raise ValueError('the number of simulations is needed without a scenario plan')
+            nb_simulation = len(self.plan.draws) - self.nb_draws
         original = sys.stdout
         null = open('/dev/null', 'w')
         pv_profiles = {}
-        for region in tqdm.tqdm(self.regions):
-            sys.stdout = null
-            scenario = self.switch_region(scenario, region)
-            pv_profiles[region] = np.array(scenario['solar_farm'])*100/1000.0
-            self.play(scenario, region)
-            sys.stdout = original
+        data = {}
+        progress = tqdm.tqdm(total=nb_simulation*len(self.regions))
+        for simulation in range(nb_simulation):
+            # for each simulation
+            index = self.nb_draws
+            self.nb_draws += 1
+            if self.batched:
+                # the regions of the draw in lockstep, one batched call per player and iteration
+                sys.stdout = null
+                games, pv_days = self.prepare_games(index, self.regions)
+                self.play_lockstep(games, pv_days)
+                sys.stdout = original
+            scenario = None
+            for region in self.regions:
+                if self.batched:
+                    scenario = games[region]
+                else:
+                    sys.stdout = null
+                    scenario = self.prepare_game(index, region, scenario)
+                    self.play(scenario, region)
+                    sys.stdout = original
+                if simulation == 0:
+                    pv_profiles[region] = np.array(scenario['solar_farm'])*100/1000.0
+                self.record_game(region, index)
+                progress.update()
+            if simulation == 0:
+                data = self.data_viz(self.__results)
+        progress.close()
 
         self.reset()
 
-        return self.data_viz(self.__results), pv_profiles
+        return data, pv_profiles
+
+    def stream(self, draws, writer=None, regions=None, rolling=False):
+        """play the given draws of the scenario plan one at a time, in every region
+
+        a generator of (draw, region, metrics): each game is reduced into
+        self.statistics (and written to writer, a streaming.MetricsWriter,
+        flushed after each draw) before the next one starts, so that e.g. the
+        365 days of ScenarioPlan.full_year run in bounded memory.
+        With rolling=True the draws are consecutive days, see roll; else the
+        regions of a draw are played by play_lockstep if the team is batched
+        """
+        if regions is None:
+            regions = self.regions
+        states, prices = {}, {}
+        original = sys.stdout
+        with open('/dev/null', 'w') as null:
+            for index in draws:
+                lockstep = self.batched and not rolling
+                if lockstep:
+                    sys.stdout = null
+                    try:
+                        self.play_lockstep(*self.prepare_games(index, regions))
+                    finally:
+                        sys.stdout = original
+                for region in regions:
+                    if not lockstep:
+                        sys.stdout = null
+                        try:
+                            scenario = self.prepare_game(index, region)
+                            self.play(scenario, region, states.get(region), prices.get(region))
+                        finally:
+                            sys.stdout = original
+                    if rolling:
+                        states[region] = self.export_player_states()
+                        prices[region] = self.final_prices[region]
+                    metrics = self.game_metrics(region)
+                    weight = 1. if self.plan is None else self.plan.weight(index)
+                    record_metrics(self.statistics[region], metrics, weight)
+                    if writer is not None:
+                        writer.write(self.team_name, region, index, weight, metrics)
+                    yield index, region, metrics
+                if writer is not None:
+                    writer.flush()
+                self.nb_draws = max(self.nb_draws, index + 1)
+
+    def roll(self, draws, writer=None, regions=None):
+        """rolling horizon: play the given draws of the scenario plan as consecutive days
+
+        in each region, the players implementing get_state/set_state start day
+        d+1 from their state at the end of day d (e.g. battery or EV state of
+        charge), and the coordination of day d+1 starts from the final prices of
+        day d. A generator of (draw, region, metrics), like stream; typically
+        over the days of ScenarioPlan.full_year
+        """
+        return self.stream(draws, writer, regions, rolling=True)
+
+    def game_metrics(self, region):
+        """metrics of the last iteration of the game played in region"""
+        region_results = self.__results[region]
+        last_iteration = region_results[max(region_results)]
+        metrics = calc_game_metrics(last_iteration['player_loads'], self.external_prices['purchase'],
+                                    self.external_prices['sale'], self.dt*3600)
+        metrics['iterations'] = len(region_results)
+        # failed calls of sandboxed players are penalised
+        metrics['player_failures'] = self.convergence[region]['failures']
+        metrics['score'] += self.failure_penalty * metrics['player_failures']
+        metrics['microgrid_load'] = last_iteration['microgrid_load']
+        return metrics
+
+    def record_game(self, region, index=None):
+        """add the metrics of the game played in region to the running statistics, weighted by the plan"""
+        weight = 1. if self.plan is None or index is None else self.plan.weight(index)
+        record_metrics(self.statistics[region], self.game_metrics(region), weight)
+
+    def game_data_viz(self, region):
+        """loads of the game played in region, in the format of data_viz"""
+        return self.data_viz({region: self.__results[region]})
 
     def data_viz(self, results):
         data = {}
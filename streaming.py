@@ -0,0 +1,78 @@
+# python 3
+#
+# incremental csv output of the metrics of every game, so that long runs (e.g.
+# the full year) keep bounded memory and a partial run is usable and resumable
+
+import os
+import csv
+import numpy as np
+
+
+class MetricsWriter:
+    """
+    appends the scalar metrics of every (team, region, draw) game to a csv file
+    (sep=";"), one row per metric (long format, so that teams with different
+    actors and bill_* metrics share the columns), flushed after each chunk of games
+
+    the games already in the file are given by read, so that an interrupted
+    run can be resumed without playing them again. The first line
+    of the file is a comment with the digest of the settings of the run (see
+    result_cache.context_digest), checked by check_context before resuming
+    """
+
+    key_columns = ['team', 'region', 'draw', 'weight']
+    columns = key_columns + ['metric', 'value']
+    context_prefix = '# context: '
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        # games written by a previous run, and the digest of its settings
+        self.has_games = os.path.exists(path) and os.path.getsize(path) > 0
+        self.context = None
+        self.file_context = None
+        if self.has_games:
+            with open(path) as f:
+                line = f.readline()
+            if line.startswith(self.context_prefix):
+                self.file_context = line[len(self.context_prefix):].strip()
+
+    def check_context(self, context):
+        """set the digest of the settings of the run, which must be those of the games already in the file"""
+        if self.has_games and self.file_context != context:
+            raise ValueError(f'{self.path} was written with other settings (seed, plan, slot duration, '
+                             f'manager options or code), resume with the same settings or use a new file')
+        self.context = context
+
+    def read(self):
+        """games of the file as (team, region, draw, weight, {metric: value})"""
+        games = {}
+        if not self.has_games:
+            return []
+        with open(self.path, newline='') as f:
+            for row in csv.DictReader((line for line in f if not line.startswith('#')), delimiter=';'):
+                key = (row['team'], row['region'], int(row['draw']))
+                if key not in games:
+                    games[key] = (float(row['weight']), {})
+                games[key][1][row['metric']] = float(row['value'])
+        return [key + game for key, game in games.items()]
+
+    def write(self, team, region, draw, weight, metrics: dict):
+        """buffer the scalar metrics of a game, until the next flush"""
+        for name, value in metrics.items():
+            if np.ndim(value) == 0:
+                self.rows.append({'team': team, 'region': region, 'draw': draw, 'weight': weight,
+                                  'metric': name, 'value': value})
+
+    def flush(self):
+        if not self.rows:
+            return
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, self.columns, delimiter=';')
+            if not self.has_games:
+                if self.context is not None:
+                    f.write(f'{self.context_prefix}{self.context}\n')
+                writer.writeheader()
+                self.has_games = True
+            writer.writerows(self.rows)
+        self.rows = []
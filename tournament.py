@@ -0,0 +1,433 @@
+# python 3
+#
+# execution of a tournament as independent (team, region, scenario) tasks,
+# serially or on a pool of worker processes, with identical results
+
+import os
+import sys
+import copy
+import multiprocessing
+from collections import namedtuple, defaultdict
+from multiprocessing import util
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tqdm
+
+from simulate import Manager
+from scenario_store import ScenarioStore, get_scenario_store, SLOT_MINUTES
+from monte_carlo import new_region_statistics, record_metrics
+from result_cache import team_revision, store_digest, code_digest, context_digest
+
+
+Task = namedtuple('Task', ['team', 'region', 'scenario'])
+
+
+def expand_tasks(draws: dict, first_scenarios: dict, regions):
+    """tasks of draws {team: number of scenarios}, numbered from first_scenarios {team: index}"""
+    return [Task(team, region, scenario)
+            for team, nb_draws in draws.items()
+            for scenario in range(first_scenarios.get(team, 0), first_scenarios.get(team, 0) + nb_draws)
+            for region in regions]
+
+
+def group_tasks(tasks, batched_teams):
+    """units of work: the consecutive tasks of a draw of a batched team together (see run_lockstep), the others alone"""
+    units = []
+    for task in tasks:
+        if units and task.team in batched_teams and (units[-1][0].team, units[-1][0].scenario) == (task.team, task.scenario):
+            units[-1].append(task)
+        else:
+            units.append([task])
+    return units
+
+
+# state of the current (worker) process, see init_worker
+_worker = {}
+
+
+def init_worker(config, store_handle=None):
+    """initialize a process running tasks: attach the store and prepare the managers cache"""
+    if store_handle is None:
+        store = get_scenario_store(config['prices'], slot_minutes=config['slot_minutes'])
+    else:
+        store = ScenarioStore.attach(store_handle)
+    _worker.clear()
+    _worker.update(config=config, store=store, managers={})
+    if store_handle is not None:
+        # pool worker: stop the processes of the players (sandbox, process backend) before exiting
+        util.Finalize(None, close_managers, exitpriority=20)
+
+
+def close_managers():
+    """close the managers of this process, see Manager.close"""
+    for manager in _worker.get('managers', {}).values():
+        manager.close()
+    _worker.get('managers', {}).clear()
+
+
+def get_manager(team):
+    """manager of a team in this process, players are imported once per process"""
+    managers = _worker['managers']
+    if team not in managers:
+        config = _worker['config']
+        options = {name: value if name in ('warm_start', 'plan', 'player_backend', 'response_cache') else copy.deepcopy(value)
+                   for name, value in config['manager_options'].items()}
+        managers[team] = Manager(team, config['players'], config['prices'], config['regions'],
+                                 store=_worker['store'], teams=config['teams'], seed=config['seed'],
+                                 slot_minutes=config['slot_minutes'], **options)
+    return managers[team]
+
+
+def is_batched(team):
+    """whether a player of team implements the batched protocol, see Manager.batched"""
+    return get_manager(team).batched
+
+
+def run_task(task):
+    """play the game of a task and return its metrics (and loads, for the first scenario)"""
+    manager = get_manager(task.team)
+
+    # random streams of the task: (team, scenario) for the (IC, DC, EV) draw, plus the region for the PV day
+    scenario = manager.prepare_game(task.scenario, task.region)
+
+    original = sys.stdout
+    with open('/dev/null', 'w') as null:
+        sys.stdout = null
+        try:
+            manager.play(scenario, task.region)
+        finally:
+            sys.stdout = original
+    return task_result(manager, task, scenario)
+
+
+def run_lockstep(tasks):
+    """play the tasks of a draw of a batched team, their regions in lockstep (see Manager.play_lockstep)"""
+    manager = get_manager(tasks[0].team)
+    games, pv_days = manager.prepare_games(tasks[0].scenario, [task.region for task in tasks])
+
+    original = sys.stdout
+    with open('/dev/null', 'w') as null:
+        sys.stdout = null
+        try:
+            manager.play_lockstep(games, pv_days)
+        finally:
+            sys.stdout = original
+    return [task_result(manager, task, games[task.region]) for task in tasks]
+
+
+def run_unit(tasks):
+    """results of a unit of group_tasks"""
+    if get_manager(tasks[0].team).batched:
+        return run_lockstep(tasks)
+    return [run_task(task) for task in tasks]
+
+
+def task_result(manager, task, scenario, metrics=None):
+    """metrics of the game of a task, unless given (and loads, for the first scenario)"""
+    if metrics is None:
+        metrics = manager.game_metrics(task.region)
+    result = {'metrics': metrics, 'saved_calls': manager.nbr_iterations - metrics['iterations'],
+              'data': None, 'pv_profile': None, 'player_usage': (os.getpid(), manager.player_usage()),
+              'response_cache': (os.getpid(), None if manager.response_cache is None else manager.response_cache.stats())}
+    if task.scenario == 0:
+        result['data'] = manager.game_data_viz(task.region)
+        result['pv_profile'] = np.array(scenario['solar_farm'])*100/1000.0
+    return result
+
+
+def run_chain(chain):
+    """play the draws of a (team, region, draws) chain as consecutive days, see Manager.roll"""
+    team, region, draws = chain
+    manager = get_manager(team)
+    results = []
+    for index, _, metrics in manager.roll(draws, regions=[region]):
+        # only the PV of the first scenario is kept (see task_result)
+        scenario = {'solar_farm': manager.store.get('solar_farm', manager.pv_day, region)} if index == 0 else None
+        task = Task(team, region, index)
+        results.append((task, task_result(manager, task, scenario, metrics)))
+    return results
+
+
+class Tournament:
+    """
+    plays the scenario draws of every team, as (team, region, scenario) tasks
+
+    with workers > 1 the tasks are run by a process pool, each idle worker
+    taking the next task (dynamic load balancing); the scenario store is
+    published in shared memory for the workers. Every task draws from its own
+    numpy SeedSequence stream (see Manager.game_seed_sequences) and results are
+    merged in the task order, so that the statistics do not depend on the
+    number of workers, nor on the other tasks played. The tasks of a draw of
+    a team with a batched player (see player_batch) are run together, their
+    regions in lockstep (see Manager.play_lockstep)
+
+    With a result_cache (result_cache.ResultCache), the first draws of a team
+    whose code is committed in players_dir are looked up in the cache by git
+    commit, and only the teams that changed since they were cached are played
+    """
+
+    def __init__(self, players, teams, prices, regions, manager_options=None, seed=123, workers=1,
+                 slot_minutes=SLOT_MINUTES, result_cache=None, players_dir='players'):
+        self.regions = regions
+        self.teams = list(teams)
+        self.workers = workers
+        self.config = {'players': players, 'teams': teams, 'prices': prices, 'regions': regions,
+                       'manager_options': manager_options or {}, 'seed': seed, 'slot_minutes': slot_minutes}
+        self.statistics = {team: defaultdict(new_region_statistics) for team in self.teams}
+        self.nb_scenarios = {team: 0 for team in self.teams}
+        self.data = {}
+        self.pv_profiles = {}
+        self.saved_calls = 0
+        # latest cumulated usage of the sandboxed players of each (process, team)
+        self._player_usage = {}
+        # latest statistics of the response cache of each process
+        self._response_cache_stats = {}
+        self.result_cache = result_cache
+        self.players_dir = players_dir
+        self._store_key = None
+        self._code_key = None
+        self._batched_teams = None
+        self._published = None
+        self._executor = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            self._published = get_scenario_store(self.config['prices'],
+                                                 slot_minutes=self.config['slot_minutes']).publish()
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=init_worker,
+                                                 initargs=(self.config, self._published.handle))
+        else:
+            init_worker(self.config)
+        return self
+
+    def __exit__(self, *exc):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        else:
+            close_managers()
+        if self._published is not None:
+            self._published.close()
+            self._published = None
+
+    def play(self, draws: dict):
+        """play more scenario draws, given as a dict. {team: number of draws}"""
+        plan = self.config['manager_options'].get('plan')
+        if plan is not None and draws:
+            # workers extend their copy of the plan the same way, this one is saved by run.py
+            plan.ensure(max(self.nb_scenarios[team] + nb_draws for team, nb_draws in draws.items()))
+        cached, contexts = self.load_cached(draws)
+        for team, results in cached.items():
+            for task, result in results:
+                self.merge_result(task, result)
+        tasks = expand_tasks({team: nb_draws for team, nb_draws in draws.items() if team not in cached},
+                             self.nb_scenarios, self.regions)
+        played = defaultdict(list)
+        for task, result in tqdm.tqdm(zip(tasks, self.run(tasks)), total=len(tasks)):
+            self.merge_result(task, result)
+            if task.team in contexts:
+                played[task.team].append((task, result))
+        for team, results in played.items():
+            self.save_cached(team, contexts[team], results)
+        for team, nb_draws in draws.items():
+            self.nb_scenarios[team] += nb_draws
+
+    def cache_key(self, team, nb_draws):
+        """(revision, context) of the first nb_draws of team in the result cache, or None if not cacheable"""
+        if self.result_cache is None or self.nb_scenarios[team] > 0 or nb_draws == 0:
+            return None
+        if self.config['manager_options'].get('warm_start') is not None:
+            # the games depend on the prices of the games played before them
+            return None
+        revision = team_revision(team, self.config['teams'][team], self.players_dir)
+        if revision is None:
+            # not a git repository, or uncommitted changes: always played
+            return None
+        return revision, self.context(nb_draws)
+
+    def context(self, nb_draws):
+        """digest of the scenarios, code of the manager and settings of the first nb_draws, see result_cache"""
+        if self._store_key is None:
+            self._store_key = store_digest(get_scenario_store(self.config['prices'],
+                                                              slot_minutes=self.config['slot_minutes']))
+            # results computed by another version of the manager are not reused
+            self._code_key = code_digest(os.path.dirname(os.path.abspath(__file__)))
+        return context_digest(self._store_key, self._code_key, self.config, nb_draws)
+
+    def load_cached(self, draws):
+        """results {team: [(task, result)]} of the teams found in the result cache, and the keys of the others"""
+        cached, keys = {}, {}
+        for team, nb_draws in draws.items():
+            key = self.cache_key(team, nb_draws)
+            if key is None:
+                continue
+            results = self.result_cache.load(team, *key)
+            if results is None:
+                keys[team] = key
+            else:
+                cached[team] = results
+        return cached, keys
+
+    def save_cached(self, team, key, results):
+        # the usage of the players is kept apart from the live processes, not the statistics of their response caches
+        results = [(task, dict(result, player_usage=(('cache', result['player_usage'][0]), result['player_usage'][1]),
+                               response_cache=(None, None)))
+                   for task, result in results]
+        self.result_cache.save(team, *key, results)
+
+    def stream_context(self):
+        """
+        digest of the settings of a streamed run: the whole plan of a fixed
+        design, only the seed of a random plan (its draws follow from it), so
+        that a run can be resumed with more draws
+        """
+        plan = self.config['manager_options'].get('plan')
+        return self.context(0 if plan is None or plan.design == 'random' else len(plan.draws))
+
+    def stream(self, draws, writer=None, chunk_size=30):
+        """
+        play the draws (indices in the scenario plan, e.g. every day of
+        ScenarioPlan.full_year) of every team, chunk_size draws at a time
+
+        the tasks of a chunk are spread over the workers, then their metrics are
+        reduced into the statistics and flushed to writer (streaming.MetricsWriter)
+        before the next chunk starts: memory does not grow with the number of
+        draws. The games already in the file of writer (written with the same
+        settings) are read back into the statistics instead of being played
+        again, except those of draw 0, replayed for the loads of the summary
+        """
+        draws = list(draws)
+        plan = self.config['manager_options'].get('plan')
+        if plan is not None and draws:
+            plan.ensure(max(draws) + 1)
+        completed = set()
+        if writer is not None:
+            writer.check_context(self.stream_context())
+            for team, region, draw, weight, metrics in writer.read():
+                if team in self.statistics and region in self.regions:
+                    record_metrics(self.statistics[team][region], metrics, weight)
+                    completed.add((team, region, draw))
+
+        nb_replayed = sum(1 for task in completed if task[2] == 0 and 0 in draws)
+        progress = tqdm.tqdm(total=len(draws)*len(self.teams)*len(self.regions) - len(completed) + nb_replayed)
+        for start in range(0, len(draws), chunk_size):
+            tasks = [Task(team, region, draw)
+                     for team in self.teams for draw in draws[start:start + chunk_size] for region in self.regions
+                     if (team, region, draw) not in completed or draw == 0]
+            for task, result in zip(tasks, self.run(tasks)):
+                progress.update()
+                if (task.team, task.region, task.scenario) in completed:
+                    self.merge_viz(task, result)
+                    continue
+                weight = self.merge_result(task, result)
+                if writer is not None:
+                    writer.write(task.team, task.region, task.scenario, weight, result['metrics'])
+            if writer is not None:
+                writer.flush()
+        progress.close()
+        for team in self.teams:
+            self.nb_scenarios[team] = max([self.nb_scenarios[team]] + [draw + 1 for draw in draws])
+
+    def roll(self, draws, writer=None):
+        """
+        rolling horizon over the draws (consecutive days, e.g. of
+        ScenarioPlan.full_year): each (team, region) chain of days is played in
+        order by one worker, carrying the player states and prices from a day
+        to the next (see Manager.roll); the chains run in parallel. A rolling
+        run cannot be resumed, writer must be on a new file
+        """
+        draws = list(draws)
+        if writer is not None and writer.has_games:
+            raise ValueError(f'{writer.path} already has games, a rolling run starts from a new file')
+        plan = self.config['manager_options'].get('plan')
+        if plan is not None and draws:
+            plan.ensure(max(draws) + 1)
+        if writer is not None:
+            writer.check_context(self.stream_context())
+        chains = [(team, region, draws) for team in self.teams for region in self.regions]
+        if self._executor is not None:
+            results = self._executor.map(run_chain, chains, chunksize=1)
+        else:
+            results = map(run_chain, chains)
+        for chain_results in tqdm.tqdm(results, total=len(chains)):
+            for task, result in chain_results:
+                weight = self.merge_result(task, result)
+                if writer is not None:
+                    writer.write(task.team, task.region, task.scenario, weight, result['metrics'])
+            if writer is not None:
+                writer.flush()
+        for team in self.teams:
+            self.nb_scenarios[team] = max([self.nb_scenarios[team]] + [draw + 1 for draw in draws])
+
+    @property
+    def player_usage(self):
+        """calls, failures and resources of the sandboxed players, {team: {player type: usage}}, over all processes"""
+        total = {}
+        for (_, team), usage in self._player_usage.items():
+            for player_type, player_usage in usage.items():
+                team_usage = total.setdefault(team, {}).setdefault(player_type, {})
+                for name, value in player_usage.items():
+                    if name == 'max_rss_mb':
+                        team_usage[name] = max(team_usage.get(name, 0.), value)
+                    else:
+                        team_usage[name] = team_usage.get(name, 0) + value
+        return total
+
+    @property
+    def response_cache_stats(self):
+        """hits, misses and hit rate of the response caches of the pure players, over all processes"""
+        hits = sum(stats['hits'] for stats in self._response_cache_stats.values())
+        misses = sum(stats['misses'] for stats in self._response_cache_stats.values())
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.}
+
+    @property
+    def batched_teams(self):
+        """teams with a player implementing the batched protocol, asked once to a worker"""
+        if self._batched_teams is None:
+            if self._executor is not None:
+                flags = self._executor.map(is_batched, self.teams)
+            else:
+                flags = map(is_batched, self.teams)
+            self._batched_teams = {team for team, batched in zip(self.teams, flags) if batched}
+        return self._batched_teams
+
+    def run(self, tasks):
+        """results of the tasks, in their order; the regions of a draw of a batched team are played together"""
+        units = group_tasks(tasks, self.batched_teams if tasks else set())
+        if self._executor is not None:
+            results = self._executor.map(run_unit, units, chunksize=1)
+        else:
+            results = map(run_unit, units)
+        return (result for unit_results in results for result in unit_results)
+
+    def merge_result(self, task, result):
+        """add the result of a task to the statistics, return its weight"""
+        plan = self.config['manager_options'].get('plan')
+        weight = 1. if plan is None else plan.weight(task.scenario)
+        record_metrics(self.statistics[task.team][task.region], result['metrics'], weight)
+        self.saved_calls += result['saved_calls']
+        pid, usage = result['player_usage']
+        self._player_usage[(pid, task.team)] = usage
+        pid, stats = result['response_cache']
+        if stats is not None:
+            self._response_cache_stats[pid] = stats
+        self.merge_viz(task, result)
+        return weight
+
+    def merge_viz(self, task, result):
+        """add the loads of the game of a task (first draw only) to the data of the summary"""
+        if result['data'] is not None:
+            merge(self.data, result['data'])
+            self.pv_profiles[task.region] = result['pv_profile']
+
+
+def merge(a: dict, b: dict):
+    for k, v in b.items():
+        if k in a:
+            if isinstance(v, dict):
+                merge(a[k], v)
+            else:
+                a[k] = v
+        else:
+            a[k] = v
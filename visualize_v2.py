@@ -16,14 +16,14 @@ import numpy as np
 # perso
 from create_ppt_summary_of_run import create_current_run_dir, create_summary_of_run_ppt
 from calc_output_metrics import calc_per_actor_bills, calc_microgrid_collective_metrics, \
-               calc_cost_autonomy_tradeoff_last_iter, get_best_team_per_region, \
+               calc_cost_autonomy_tradeoff_last_iter, get_best_team_per_region, get_best_teams, \
                get_france_team_classif, save_all_metrics_to_csv, save_per_region_score_to_csv, \
-               get_improvement_traj
+               get_improvement_traj, CONTRACTED_P_TARIFFS, COLL_METRICS_WEIGHTS
 
 
 # TODO get data from simu OJ format
 
-def generate_pptx(data, pv_profiles):
+def generate_pptx(data, pv_profiles, slot_minutes=30, mc_team_scores=None):
     current_dir = os.getcwd()
     date_of_run = datetime.datetime.now()
     idx_run = 1
@@ -36,14 +36,14 @@ def generate_pptx(data, pv_profiles):
     podium_france_file = os.path.join(current_dir, "images", "podium_france_v2.png")
 
     # temporal parameters Q2OJ: fixed here or from your code?
-    delta_t_s = 1800 # time-slot duration (s)
+    delta_t_s = 60 * slot_minutes # time-slot duration (s), as in the games
     start_optim_period = datetime.datetime(2018,1,1)
     optim_period = pd.date_range(start=start_optim_period, 
                                  end=start_optim_period+timedelta(hours=24),
                                  freq="%is" % delta_t_s)[:-1]
     coord_method = "price-coord. dyn."
     # Collective metrics calculation
-    n_ts = 48 # number of discrete time-slots
+    n_ts = 24 * 3600 // delta_t_s # number of discrete time-slots
     load_profiles = data #{} # TODO OJ: fixer ce dict. avec clés 1. Industrial Cons. scenario;
     # 2. Data Center scenario; 3. PV scenario; 4. EV scenario; 5. microgrid team name; 
     # 6. Iteration; 7. actor type (N.B. charging_station_1, charging_station_2... 
@@ -57,14 +57,11 @@ def generate_pptx(data, pv_profiles):
     # "external" (real) elec. prices Q2OJ: fixed here or from your code?
     purchase_price = 0.10 + 0.1 * np.random.rand(n_ts)
     sale_price = 0.05 + 0.1 * np.random.rand(n_ts)
-    # pmax contract cost (fixed here "en dur")
-    contracted_p_tariffs = {6: 123.6, 9: 151.32, 12: 177.24, 15: 201.36,
-                            18: 223.68, 24: 274.68, 30: 299.52, 36: 337.56}
+    # pmax contract cost (fixed "en dur" in calc_output_metrics)
+    contracted_p_tariffs = CONTRACTED_P_TARIFFS
     # weights for the different collective microgrid metrics
     # TODO OB+OJ fixer valeurs choisies par Fanny et Nouhayla avant le run
-    # N.B. pour l'instant "mg_transfo_aging" et "n_disj" pas utilisés
-    coll_metrics_weights = {"pmax_cost": 1/365, "autonomy_score": 1,
-                            "mg_transfo_aging": 0, "n_disj": 0}
+    coll_metrics_weights = COLL_METRICS_WEIGHTS
     metrics_not_saved = ["mg_transfo_aging", "n_disj"]
 
 
@@ -96,6 +93,10 @@ def generate_pptx(data, pv_profiles):
     team_scores, best_teams_per_region, coll_metrics_names = \
             get_best_team_per_region(per_actor_bills, collective_metrics,
                                      coll_metrics_weights)
+    if mc_team_scores is not None:
+        # (weighted) Monte-Carlo means over all the draws, the loads above are those of the first draw only
+        team_scores = mc_team_scores
+        best_teams_per_region = get_best_teams(team_scores)
     
     # and France classification (simple aggreg. over per region scores - to be minimized)
     team_france_scores, teams_france_classif = get_france_team_classif(team_scores)